@@ -0,0 +1,22 @@
+from ..lib.binary import Writer
+from ..lib.toolchain import SideEffectsTool
+
+import sys
+
+
+class binary(SideEffectsTool):
+    def __init__(self, output=sys.stdout, *args, **kwargs):
+        super(binary, self).__init__()
+
+        if isinstance(output, list) and output and isinstance(output[0], str):
+            output = open(output[0], 'wb')
+
+        self.writer = Writer(getattr(output, 'buffer', output))
+
+    def _pipe_chunks(self, chunks, meta_data):
+        for chunk in super(binary, self)._pipe_chunks(chunks, meta_data):
+            yield chunk
+        self.writer.close()
+
+    def process_chunk(self, chunk, meta_data):
+        self.writer.write(chunk)
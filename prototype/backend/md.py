@@ -41,11 +41,18 @@ class md(SideEffectsTool):
                 else:
                     self.output.write('```\n')
 
+        elif ast.is_element_type(element, ast.TokenRun):
+            for token_class, text in element.tokens():
+                self._format_text(text)
+
         elif ast.is_element_type(element, ast.Text):
-            lines = element.text.splitlines()
-            if lines:
-                text = '%s' % '\n'.join(lines)
-                self.output.write(text)
+            self._format_text(element.text)
 
         elif ast.is_element_type(element, ast.Use):
             self.output.write('<<%s>>\n' % element.get('chunk_name'))
+
+    def _format_text(self, text):
+        lines = text.splitlines()
+        if lines:
+            text = '%s' % '\n'.join(lines)
+            self.output.write(text)
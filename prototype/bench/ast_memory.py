@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+
+# Measures the memory held by a Pygments-lexed code chunk of N lines for
+# each node storage (YAWEB_AST=etree|compact). The node classes are picked
+# when lib.ast is imported, so every storage is measured in a subprocess.
+
+import gc
+import os
+import subprocess
+import sys
+import tracemalloc
+
+
+storages = ['etree', 'compact']
+
+
+def make_chunk(lines):
+    from ..lib import ast
+
+    chunk = ast.Chunk(lang='python', weave='quoted', chunk_name='bench')
+    for i in range(lines):
+        chunk.append(ast.Text(text='def f_%d(x, y=%d): return x[%d] + y * 0x%x  # note\n' % (i, i, i, i)))
+    return chunk
+
+
+def measure(lines):
+    from ..transform.lex import lex_pygments
+
+    chunk = make_chunk(lines)
+
+    # warm up the lexer and its regex caches before measuring
+    lex_pygments(make_chunk(1))
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    lexed = lex_pygments(chunk)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return len(lexed), after - before
+
+
+def main(argv):
+    if argv and argv[0] == '--measure':
+        nodes, size = measure(int(argv[1]))
+        sys.stdout.write('%d %d\n' % (nodes, size))
+        return
+
+    sizes = [int(arg) for arg in argv] or [100, 1000, 10000]
+
+    for lines in sizes:
+        results = {}
+        for storage in storages:
+            env = dict(os.environ, YAWEB_AST=storage)
+            output = subprocess.check_output(
+                [sys.executable, '-W', 'ignore', '-m', __spec__.name, '--measure', str(lines)],
+                env=env
+            )
+            results[storage] = [int(field) for field in output.split()]
+
+        nodes, etree_size = results['etree']
+        compact_size = results['compact'][1]
+        sys.stdout.write('%6d lines %7d nodes  etree %10d B  compact %10d B  saved %10d B (%4.1f%%, %5.1f B/node)\n' % (
+            lines,
+            nodes,
+            etree_size,
+            compact_size,
+            etree_size - compact_size,
+            100.0 * (etree_size - compact_size) / etree_size,
+            float(etree_size - compact_size) / nodes
+        ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
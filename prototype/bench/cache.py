@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+
+# Weaves a book of N code chunks (lexed with Pygments, like lex does for
+# lang=python chunks) without a cache, then twice with a new on-disk cache
+# (lib/cache): once cold, as on a first CI run, and once warm, and reports
+# the time for each.
+
+from ..lib.cache import DiskCache
+from ..yaweb import Yaweb
+
+import io
+import os
+import sys
+import tempfile
+import time
+
+
+def make_web(chunks):
+    tokens = ['@file bench.nw']
+    for i in range(chunks):
+        tokens += ['@begin docs %d' % (2 * i), '@text Documentation for @code [[chunk %d]]' % i, '@nl', '@end docs %d' % (2 * i)]
+        tokens += ['@begin code %d' % (2 * i + 1), '@defn chunk %d' % i, '@text @[lang=python]', '@nl']
+        for j in range(8):
+            tokens += ['@text def f_%d(x, y=%d): return [x * 0x%x for _ in range(y)]' % (j, j, i), '@nl']
+        tokens += ['@use chunk %d' % (i + 1), '@nl', '@end code %d' % (2 * i + 1)]
+    return '\n'.join(tokens) + '\n'
+
+
+def weave(text, cache):
+    output = io.StringIO()
+    yaweb = Yaweb(
+        frontend=[('noweb_tool', [], {'extended_syntax': True})],
+        backend=[('noweb_tool', [], {})],
+        input=io.StringIO(text),
+        output=output,
+        cache=cache
+    )
+
+    begin = time.perf_counter()
+    yaweb()
+    return time.perf_counter() - begin, output.getvalue()
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 2000
+    text = make_web(count)
+
+    base_time, reference = weave(text, None)
+
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = DiskCache(os.path.join(dirname, 'cache.db'))
+        cold_time, output = weave(text, cache)
+        warm_time, output = weave(text, cache)
+        stats = cache.stats()
+        cache.close()
+
+    if output != reference:
+        raise RuntimeError('output with a warm cache differs from a run without cache')
+
+    sys.stdout.write('%6d chunks  no cache %8.3f s  cold %8.3f s  warm %8.3f s  %5.1fx\n' % (
+        count,
+        base_time,
+        cold_time,
+        warm_time,
+        base_time / warm_time
+    ))
+    sys.stdout.write('%s\n' % stats)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+
+# Clones lexed code chunks of N elements, comparing ast.clone against the
+# previous eval(repr(element)) round trip.
+
+from ..lib import ast
+
+import sys
+import time
+
+
+node_types = [
+    ast.Keyword,
+    ast.Text,
+    ast.CodeEntityName,
+    ast.Operator,
+    ast.LiteralNumber,
+    ast.Punctuation,
+]
+
+
+def make_chunk(elements):
+    chunk = ast.Chunk(lang='python', weave='quoted', chunk_name='bench')
+    for i in range(elements):
+        if i % 16 == 15:
+            chunk.append(ast.Use(chunk_name='other chunk %d' % i))
+        else:
+            chunk.append(node_types[i % len(node_types)](text='token_%d ' % i))
+    return chunk
+
+
+def clone_repr(element):
+    return eval(repr(element), vars(ast))
+
+
+def measure(function, chunk, repeat):
+    begin = time.perf_counter()
+    for i in range(repeat):
+        function(chunk)
+    return (time.perf_counter() - begin) / repeat
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [10, 100, 1000, 10000]
+
+    for elements in sizes:
+        chunk = make_chunk(elements)
+        repeat = max(1, 20000 // elements)
+        before = measure(clone_repr, chunk, repeat)
+        after = measure(ast.clone, chunk, repeat)
+        sys.stdout.write('%8d elements  repr %10.1f us  clone %10.1f us  %6.1fx\n' % (
+            elements,
+            before * 1e6,
+            after * 1e6,
+            before / after
+        ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
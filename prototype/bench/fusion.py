@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+
+# Runs the default transforms of Yaweb over a web of N chunks with and
+# without stage fusion (Toolchain.configure(fuse=True)) and reports the time
+# for each, best of three. The first web has code chunks only, which no
+# stage changes, so that the time is spent passing chunks from stage to
+# stage; the second alternates documentation and lang=python chunks, which
+# are lexed.
+
+from ..lib import toolchain
+from ..lib.noweb_tool import DispatchLexer, InputBuffer, Parser
+from ..yaweb import Yaweb, YawebState
+
+import gc
+import sys
+import time
+
+
+def make_web(chunks, lexed):
+    tokens = ['@file bench.nw']
+    for i in range(chunks):
+        if lexed and i % 2 == 0:
+            tokens += ['@begin docs %d' % i, '@text Documentation for @code [[chunk %d]]' % i, '@nl', '@end docs %d' % i]
+            continue
+        tokens += ['@begin code %d' % i, '@defn chunk %d' % i]
+        tokens += ['@text @[lang=python]'] if lexed else []
+        tokens += ['@nl', '@text x_%d = f(x, %d)' % (i, i), '@nl', '@use chunk %d' % (i + 1), '@nl', '@end code %d' % i]
+    return '\n'.join(tokens) + '\n'
+
+
+def run(chunks, fuse):
+    best = None
+    for i in range(3):
+        stages = toolchain.Toolchain(Yaweb().transforms)
+        stages.configure(fuse=fuse)
+        meta_data = dict(yaweb=YawebState())
+        gc.collect()
+
+        begin = time.perf_counter()
+        for chunk in stages.pipe(iter(chunks), meta_data)[0]:
+            pass
+        elapsed = time.perf_counter() - begin
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 20000
+
+    for lexed in [False, True]:
+        chunks = list(Parser(DispatchLexer(InputBuffer(make_web(count, lexed)), True)))
+        layered = run(chunks, False)
+        fused = run(chunks, True)
+        sys.stdout.write('%6d chunks  %-9s layered %8.3f s  fused %8.3f s  %5.2fx\n' % (
+            count,
+            'lexed' if lexed else 'unlexed',
+            layered,
+            fused,
+            layered / fused
+        ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+
+# Weaves a book of N code chunks (lexed with Pygments, like lex does for
+# lang=python chunks) once from scratch, then edits one line in the middle
+# of it and weaves it again with the same incremental Yaweb instance, and
+# reports the time for each. The output of the re-run is checked against a
+# full run over the edited book.
+#
+# With --hook, the book also has meta code with a lex hook that notes how
+# often each chunk is used, and the edit adds a use of the first chunk. Each
+# chunk then uses the one before it: used_by only holds on to chunks weakly,
+# and those before the chunk being lexed are gone in a full run.
+
+from ..yaweb import Yaweb
+
+import io
+import sys
+import time
+
+
+# lex hook that appends to each code chunk how often it is used
+HOOK = '''from prototype.lib import ast
+
+def lex(chunk, meta_data):
+    name = chunk.get('chunk_name')
+    if name is None:
+        return chunk
+    result = ast.clone(chunk)
+    result.append(ast.Comment(text='# used by %d' % len(meta_data['used_by'].get(name, []))))
+    return result
+
+def lex_cache_key(chunk, meta_data):
+    return str(len(meta_data['used_by'].get(chunk.get('chunk_name'), [])))
+'''
+
+
+def make_web(chunks, edited=None, hook=False):
+    tokens = ['@file bench.nw']
+    if hook:
+        tokens += ['@begin code 0', '@defn hook', '@text @[lang=python,meta]', '@nl']
+        for line in HOOK.splitlines():
+            tokens += ['@text ' + line, '@nl']
+        tokens += ['@end code 0']
+    for i in range(chunks):
+        tokens += ['@begin docs %d' % (2 * i), '@text Documentation for @code [[chunk %d]]' % i, '@nl', '@end docs %d' % (2 * i)]
+        tokens += ['@begin code %d' % (2 * i + 1), '@defn chunk %d' % i, '@text @[lang=python]', '@nl']
+        for j in range(8):
+            tokens += ['@text def f_%d(x, y=%d): return [x * 0x%x for _ in range(y)]' % (j, j, i), '@nl']
+        if i == edited:
+            tokens += ['@text edited = True', '@nl']
+            if hook:
+                tokens += ['@use chunk 0', '@nl']
+        if not hook:
+            tokens += ['@use chunk %d' % (i + 1), '@nl']
+        elif i > 0:
+            tokens += ['@use chunk %d' % (i - 1), '@nl']
+        tokens += ['@end code %d' % (2 * i + 1)]
+    return '\n'.join(tokens) + '\n'
+
+
+def weave(yaweb, text):
+    output = io.StringIO()
+    yaweb.reload(input=io.StringIO(text), output=output)
+
+    begin = time.perf_counter()
+    yaweb()
+    return time.perf_counter() - begin, output.getvalue()
+
+
+def make_yaweb(incremental):
+    return Yaweb(
+        frontend=[('noweb_tool', [], {'extended_syntax': True})],
+        backend=[('noweb_tool', [], {})],
+        input=io.StringIO(''),
+        output=io.StringIO(),
+        incremental=incremental
+    )
+
+
+def main(argv):
+    hook = '--hook' in argv
+    argv = [arg for arg in argv if arg != '--hook']
+
+    count = int(argv[0]) if argv else 2000
+    text = make_web(count, hook=hook)
+    edited_text = make_web(count, count // 2, hook)
+
+    yaweb = make_yaweb(True)
+    full_time, output = weave(yaweb, text)
+    rerun_time, output = weave(yaweb, edited_text)
+
+    reference_time, reference = weave(make_yaweb(False), edited_text)
+    if output != reference:
+        raise RuntimeError('incremental re-run differs from a full run')
+
+    sys.stdout.write('%6d chunks  full %8.3f s  one line edited %8.3f s  %5.1fx\n' % (
+        count,
+        full_time,
+        rerun_time,
+        full_time / rerun_time
+    ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
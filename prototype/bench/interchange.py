@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+
+# Hands N chunks from one yaweb process to the next, once as noweb text
+# (backend/noweb_tool, then lexer and parser) and once in the binary format
+# (lib/binary), and reports the time for each and the size of the stream.
+
+from ..backend.noweb_tool import noweb_tool
+from ..lib import binary
+from ..lib.noweb_tool import DispatchLexer, InputBuffer, Parser
+
+import io
+import sys
+import time
+
+
+def make_web(chunks):
+    tokens = ['@file bench.nw']
+    for i in range(chunks):
+        tokens += ['@begin docs %d' % (2 * i), '@text Documentation for @code [[chunk %d]]' % i, '@nl', '@end docs %d' % (2 * i)]
+        tokens += ['@begin code %d' % (2 * i + 1), '@defn chunk %d' % i, '@text @[lang=python,tabsize=4]', '@nl']
+        for j in range(8):
+            tokens += ['@text     x_%d = f(x_%d, %d)' % (j, j - 1, i), '@nl']
+        tokens += ['@use chunk %d' % (i + 1), '@nl', '@end code %d' % (2 * i + 1)]
+    return '\n'.join(tokens) + '\n'
+
+
+def text_round_trip(chunks):
+    output = io.StringIO()
+    backend = noweb_tool(output=output)
+    for chunk in chunks:
+        backend.process_chunk(chunk, {})
+    text = output.getvalue()
+    return list(Parser(DispatchLexer(InputBuffer(text), True))), len(text.encode('utf-8'))
+
+
+def binary_round_trip(chunks):
+    data = binary.dumps(chunks)
+    return binary.loads(data), len(data)
+
+
+def measure(function, chunks):
+    begin = time.perf_counter()
+    result, size = function(chunks)
+    return time.perf_counter() - begin, size
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [100, 1000, 10000]
+
+    for count in sizes:
+        chunks = list(Parser(DispatchLexer(InputBuffer(make_web(count)), True)))
+        text_time, text_size = measure(text_round_trip, chunks)
+        binary_time, binary_size = measure(binary_round_trip, chunks)
+        sys.stdout.write('%6d chunks  text %8.3f s %10d B  binary %8.3f s %10d B  %5.1fx\n' % (
+            len(chunks),
+            text_time,
+            text_size,
+            binary_time,
+            binary_size,
+            text_time / binary_time
+        ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,42 @@
+#! /usr/bin/env python
+
+# Parses webs that consist of a single documentation chunk of N lines. The
+# time per line should stay flat as N grows; it grows linearly with N if
+# the parser extends the chunk's text one fragment at a time.
+
+from ..lib.noweb_tool import DispatchLexer, InputBuffer, Parser
+
+import sys
+import time
+
+
+def make_web(lines):
+    tokens = ['@file bench.nw', '@begin docs 0']
+    for i in range(lines):
+        tokens.append('@text line %d of a long documentation chunk' % i)
+        tokens.append('@nl')
+    tokens.append('@end docs 0')
+    return '\n'.join(tokens) + '\n'
+
+
+def parse(web):
+    return list(Parser(DispatchLexer(InputBuffer(web))))
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [6250, 12500, 25000, 50000]
+
+    for lines in sizes:
+        web = make_web(lines)
+        begin = time.perf_counter()
+        parse(web)
+        elapsed = time.perf_counter() - begin
+        sys.stdout.write('%8d lines  %8.3f s  %8.2f us/line\n' % (
+            lines,
+            elapsed,
+            elapsed / lines * 1e6
+        ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
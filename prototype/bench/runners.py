@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+
+# Weaves a book of N lang=python code chunks (lexed with Pygments), eight of
+# which are evaluated with a shell command that takes a second, with each
+# pipeline runner, and reports the time for each. The output of every runner
+# is checked against that of the default one. Each run is done in a new
+# temporary directory, so that no eval result is taken from the cache of a
+# previous run. The TASKS eval tasks run at the same time (--eval_workers), so
+# that the runners don't depend on the number of CPUs.
+
+from ..yaweb import Yaweb
+
+import io
+import os
+import sys
+import tempfile
+import time
+
+RUNNERS = [None, 'async', 'threads']
+TASKS = 8
+
+
+def make_web(chunks, delay):
+    tokens = ['@file bench.nw']
+    for i in range(chunks):
+        tokens += ['@begin docs %d' % (2 * i), '@text Documentation for @code [[chunk %d]]' % i, '@nl', '@end docs %d' % (2 * i)]
+        tokens += ['@begin code %d' % (2 * i + 1), '@defn chunk %d' % i]
+        if i % (chunks // TASKS) == 0:
+            tokens += ['@text @[lang=python,eval=shell://sleep %s; cat]' % delay, '@nl']
+        else:
+            tokens += ['@text @[lang=python]', '@nl']
+        for j in range(8):
+            tokens += ['@text def f_%d(x, y=%d): return [x * 0x%x for _ in range(y)]' % (j, j, i), '@nl']
+        tokens += ['@end code %d' % (2 * i + 1)]
+    return '\n'.join(tokens) + '\n'
+
+
+def weave(text, runner):
+    output = io.StringIO()
+    yaweb = Yaweb(
+        frontend=[('noweb_tool', [], {'extended_syntax': True})],
+        backend=[('noweb_tool', [], {})],
+        input=io.StringIO(text),
+        output=output,
+        runner=runner,
+        eval_workers=TASKS
+    )
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as dirname:
+        os.chdir(dirname)
+        try:
+            begin = time.perf_counter()
+            yaweb()
+            elapsed = time.perf_counter() - begin
+        finally:
+            os.chdir(cwd)
+
+    return elapsed, output.getvalue()
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 2000
+    delay = argv[1] if len(argv) > 1 else '1'
+    text = make_web(count, delay)
+
+    reference = None
+    for runner in RUNNERS:
+        elapsed, output = weave(text, runner)
+        if reference is None:
+            reference = output
+        elif output != reference:
+            raise RuntimeError('output of the %s runner differs' % runner)
+
+        sys.stdout.write('%6d chunks  %-8s %8.3f s\n' % (count, runner or 'default', elapsed))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
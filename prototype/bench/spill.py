@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+
+# Weaves a book of N code chunks, each with a page of documentation before
+# it, once with the fences holding the whole web in memory and once with
+# --spill, and reports the time and the peak memory (maximum resident set
+# size) of each run. Every run is done in a child process of its own, so
+# that the peaks can be told apart.
+
+from ..yaweb import Yaweb
+
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+
+def make_web(chunks):
+    tokens = ['@file bench.nw']
+    for i in range(chunks):
+        tokens += ['@begin docs %d' % (2 * i)]
+        for j in range(16):
+            tokens += ['@text Paragraph %d of the documentation for @code [[chunk %d]]@endcode, which goes on for a while.' % (j, i), '@nl']
+        tokens += ['@end docs %d' % (2 * i)]
+        tokens += ['@begin code %d' % (2 * i + 1), '@defn chunk %d' % i, '@nl']
+        tokens += ['@text x_%d = f(x, %d)' % (i, i), '@nl', '@use chunk %d' % (i + 1), '@nl', '@end code %d' % (2 * i + 1)]
+    return '\n'.join(tokens) + '\n'
+
+
+def weave(path, spill, connection):
+    with open(path) as input, open(os.devnull, 'w') as output:
+        yaweb = Yaweb(
+            frontend=[('noweb_tool', [], {'extended_syntax': True})],
+            backend=[('noweb_tool', [], {})],
+            input=input,
+            output=output,
+            spill=spill
+        )
+
+        begin = time.perf_counter()
+        yaweb()
+        elapsed = time.perf_counter() - begin
+
+    # kilobytes on Linux
+    connection.send((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    connection.close()
+
+
+def run(path, spill):
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=weave, args=(path, spill, sender))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 20000
+    spill = int(argv[1]) if len(argv) > 1 else 1000
+
+    with tempfile.TemporaryDirectory() as dirname:
+        path = os.path.join(dirname, 'bench.nw')
+        with open(path, 'w') as file:
+            file.write(make_web(count))
+
+        for limit in [None, spill]:
+            elapsed, peak = run(path, limit)
+            sys.stdout.write('%6d chunks  %-12s %8.3f s  peak %8.1f MiB\n' % (
+                count,
+                'in memory' if limit is None else 'spill=%d' % limit,
+                elapsed,
+                peak / 1024.0
+            ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+
+# Runs the lex stage over a web of N code chunks with 1, 2, 4, ... worker
+# processes (up to the number of CPUs) and reports the time for each.
+
+from ..lib import toolchain
+from ..lib.noweb_tool import DispatchLexer, InputBuffer, Parser
+from ..transform.lex import Lexer
+
+import os
+import sys
+import time
+import types
+
+
+def make_web(chunks):
+    tokens = ['@file bench.nw']
+    for i in range(chunks):
+        tokens += ['@begin code %d' % i, '@defn chunk %d' % i, '@text @[lang=python]', '@nl']
+        for j in range(20):
+            tokens += ['@text def f_%d(x, y=%d): return [x * 0x%x for _ in range(y)]  # %d' % (j, j, i, j), '@nl']
+        tokens += ['@end code %d' % i]
+    return '\n'.join(tokens) + '\n'
+
+
+def run(chunks, jobs):
+    stages = toolchain.Toolchain([Lexer()])
+    stages.configure(jobs=jobs)
+    meta_data = dict(yaweb=types.ModuleType('yaweb'))
+
+    begin = time.perf_counter()
+    for chunk in stages.pipe(iter(chunks), meta_data)[0]:
+        pass
+    return time.perf_counter() - begin
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 2000
+    chunks = list(Parser(DispatchLexer(InputBuffer(make_web(count)), True)))
+
+    jobs = 1
+    base = None
+    while True:
+        elapsed = run(chunks, jobs)
+        base = base or elapsed
+        sys.stdout.write('%6d chunks  jobs %3d  %8.3f s  %5.2fx\n' % (count, jobs, elapsed, base / elapsed))
+        if jobs >= (os.cpu_count() or 1):
+            break
+        jobs = min(jobs * 2, os.cpu_count())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,20 @@
+from ..lib.binary import Reader
+from ..lib import ast
+
+import sys
+
+
+class binary(object):
+    def __init__(self, input=sys.stdin, *args, **kwargs):
+        if isinstance(input, list) and input and isinstance(input[0], str):
+            input = open(input[-1], 'rb')
+
+        self.input = getattr(input, 'buffer', input)
+
+    def __iter__(self):
+        for node in Reader(self.input):
+            if ast.is_element_type(node, ast.Web):
+                for chunk in node:
+                    yield chunk
+            else:
+                yield node
@@ -1,11 +1,72 @@
-from ..lib.noweb_tool import Lexer, Parser
+from ..lib.noweb_tool import Lexer, DispatchLexer, Parser
+from ..lib.noweb_tool import InputBuffer, read_buffered, read_mapped, split_files
+from multiprocessing import Pool
+import os
 import sys
 
 
+lexers = {
+    'regex':    Lexer,
+    'dispatch': DispatchLexer,
+}
+
+
+def _parse_section(section):
+    text, extended_syntax, lexer = section
+    return list(Parser(lexers[lexer](InputBuffer(text), extended_syntax)))
+
+
 class noweb_tool(object):
-    def __init__(self, input=sys.stdin, extended_syntax=False, *args, **kwargs):
-        self.lexer = Lexer(input, extended_syntax)
+    def __init__(self, input=sys.stdin, extended_syntax=False, lexer='regex',
+            input_mode='stream', block_size=1 << 20, parse_jobs=None, *args, **kwargs):
+        if isinstance(lexer, list) and lexer and isinstance(lexer[0], str):
+            lexer = lexer[-1]
+
+        if isinstance(input_mode, list) and input_mode and isinstance(input_mode[0], str):
+            input_mode = input_mode[-1]
+
+        if isinstance(block_size, list) and block_size and isinstance(block_size[0], str):
+            block_size = int(block_size[-1])
+
+        if isinstance(parse_jobs, list) and parse_jobs and isinstance(parse_jobs[0], str):
+            parse_jobs = int(parse_jobs[-1]) if parse_jobs[-1] else os.cpu_count()
+
+        if isinstance(input, list) and input and isinstance(input[0], str):
+            input = input[-1]
+
+        # line breaks are read with universal newlines in every mode, so that
+        # \r\n and \r end a line, too
+        if input_mode == 'mmap':
+            input = read_mapped(input, block_size=block_size)
+        else:
+            if isinstance(input, str):
+                input = open(input, 'r')
+            elif hasattr(input, 'reconfigure'):
+                input.reconfigure(newline=None)
+            if input_mode == 'buffered' or parse_jobs:
+                input = read_buffered(input, block_size)
+
+        self.extended_syntax = extended_syntax
+        self.lexer_name = lexer
+        self.input = input
+        self.parse_jobs = parse_jobs
+
+        self.lexer = lexers[lexer](input, extended_syntax)
         self.parser = Parser(self.lexer)
 
     def __iter__(self):
-        return iter(self.parser)
+        if self.parse_jobs:
+            return self._parse_parallel()
+        else:
+            return iter(self.parser)
+
+    def _parse_parallel(self):
+        # each @file section is lexed and parsed in a worker process; imap()
+        # hands the results back in the order of the sections
+        sections = [(section, self.extended_syntax, self.lexer_name) \
+                        for section in split_files(self.input.read())]
+
+        with Pool(self.parse_jobs) as pool:
+            for chunks in pool.imap(_parse_section, sections):
+                for chunk in chunks:
+                    yield chunk
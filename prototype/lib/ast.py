@@ -1,7 +1,11 @@
 from .textutils import valid_python_ident
 
+from xml.etree import ElementPath
 from xml.etree import ElementTree as ElementTree
 
+from array import array
+import os
+
 
 # XXX: Current masterplan:
 #  - There are two kinds of nodes contained in chunks, [ContentNode]s and
@@ -25,17 +29,217 @@ def is_element_type(element, element_type):
     return isinstance(element, element_type)
 
 
+def to_etree(element):
+    result = ElementTree.Element(element.tag, dict(element.items()))
+    result.text = element.text
+    result.tail = element.tail
+    result.extend([to_etree(child) for child in element])
+    return result
+
+
 def to_xml(element):
-    return ElementTree.tostring(element)
+    if isinstance(element, ElementTree.Element):
+        return ElementTree.tostring(element)
+    return ElementTree.tostring(to_etree(element))
+
+
+# Copy of a single node without its children.
+def copy_node(element):
+    return element._copy_node()
+
+
+# New node of the given class with the given attributes and text, without
+# going through the subclass constructors.
+def make_node(element_class, attrib, text=None):
+    result = element_class.__new__(element_class)
+    result._init_node(attrib, {})
+    result.text = text
+    return result
 
 
 def clone(element):
-    return eval(repr(element))
+    result = copy_node(element)
+    if not isinstance(element, TokenRun):
+        result.extend([clone(child) for child in element])
+    return result
+
+
+# Node storage backed by ElementTree.Element. The subclass constructors are
+# bypassed when copying; the element is initialized with the original's tag
+# and a copy of its attributes directly.
+class ElementTreeNode(ElementTree.Element):
+    __slots__ = ()
+
+    _weakref_slots = ()
+
+    def _init_node(self, attrib, extra):
+        ElementTree.Element.__init__(self, self.__class__.__name__, attrib, **extra)
+
+    def _copy_node(self):
+        cls = self.__class__
+        result = cls.__new__(cls)
+        ElementTree.Element.__init__(result, self.tag, self.attrib)
+        result.text = self.text
+        return result
+
+
+# Compact node storage. The tag lives on the class; attributes, children and
+# tail are kept in a list that is only created when one of them is set, so a
+# leaf node carries just its text. Only chunks can be weakly referenced.
+# Selected with YAWEB_AST=compact.
+class CompactNode(object):
+    __slots__ = ('text', '_extra')
+
+    _weakref_slots = ('__weakref__',)
+
+    def __init_subclass__(cls, **kwargs):
+        super(CompactNode, cls).__init_subclass__(**kwargs)
+        cls.tag = cls.__name__
+
+    def _init_node(self, attrib, extra):
+        self.text = None
+        self._extra = None
+        if attrib or extra:
+            self._extra = [dict(attrib, **extra), (), None]
+
+    def _copy_node(self):
+        cls = self.__class__
+        result = cls.__new__(cls)
+        result.text = self.text
+        result._extra = None
+        if self._extra is not None and self._extra[0]:
+            result._extra = [dict(self._extra[0]), (), None]
+        return result
+
+    def _extras(self):
+        if self._extra is None:
+            self._extra = [None, (), None]
+        return self._extra
+
+    def _child_list(self):
+        extra = self._extras()
+        if not isinstance(extra[1], list):
+            extra[1] = list(extra[1])
+        return extra[1]
+
+    @property
+    def _children(self):
+        if self._extra is None:
+            return ()
+        return self._extra[1]
+
+    @property
+    def tail(self):
+        if self._extra is None:
+            return None
+        return self._extra[2]
+
+    @tail.setter
+    def tail(self, tail):
+        if tail is not None or self._extra is not None:
+            self._extras()[2] = tail
+
+    @property
+    def attrib(self):
+        extra = self._extras()
+        if extra[0] is None:
+            extra[0] = {}
+        return extra[0]
+
+    @attrib.setter
+    def attrib(self, attrib):
+        self._extras()[0] = attrib
+
+    def get(self, key, default=None):
+        if self._extra is None or self._extra[0] is None:
+            return default
+        return self._extra[0].get(key, default)
+
+    def set(self, key, value):
+        self.attrib[key] = value
+
+    def keys(self):
+        if self._extra is None or self._extra[0] is None:
+            return {}.keys()
+        return self._extra[0].keys()
+
+    def items(self):
+        if self._extra is None or self._extra[0] is None:
+            return {}.items()
+        return self._extra[0].items()
+
+    def __len__(self):
+        return len(self._children)
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self._children[index])
+        return self._children[index]
+
+    def __setitem__(self, index, element):
+        self._child_list()[index] = element
+
+    def __delitem__(self, index):
+        del self._child_list()[index]
+
+    def append(self, element):
+        self._child_list().append(element)
+
+    def extend(self, elements):
+        self._child_list().extend(elements)
+
+    def insert(self, index, element):
+        self._child_list().insert(index, element)
+
+    def remove(self, element):
+        self._child_list().remove(element)
+
+    def clear(self):
+        self.text = None
+        self._extra = None
+
+    def iter(self, tag=None):
+        if tag == '*':
+            tag = None
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self._children:
+            for element in child.iter(tag):
+                yield element
+
+    def itertext(self):
+        if self.text:
+            yield self.text
+        for child in self._children:
+            for text in child.itertext():
+                yield text
+            if child.tail:
+                yield child.tail
+
+    def find(self, path, namespaces=None):
+        return ElementPath.find(self, path, namespaces)
+
+    def findall(self, path, namespaces=None):
+        return ElementPath.findall(self, path, namespaces)
+
+    def iterfind(self, path, namespaces=None):
+        return ElementPath.iterfind(self, path, namespaces)
+
+
+if os.environ.get('YAWEB_AST') == 'compact':
+    NodeBase = CompactNode
+else:
+    NodeBase = ElementTreeNode
 
 
 # Attribs may only contain string keys and string values and may only be
 # manipulated by ContentTools.
-class SyntaxElement(ElementTree.Element):
+class SyntaxElement(NodeBase):
+    __slots__ = ()
+
     def __init__(self, attrib={}, **extra):
         text = ''
         if 'text' in attrib and attrib['text'] is not None:
@@ -53,7 +257,7 @@ class SyntaxElement(ElementTree.Element):
             children += extra['children']
             del extra['children']
 
-        super(SyntaxElement, self).__init__('None', attrib, **extra)
+        self._init_node(attrib, extra)
 
         self.text = text
 
@@ -80,205 +284,256 @@ class SyntaxElement(ElementTree.Element):
 
 
 class Web(SyntaxElement):
-    def __init__(self, attrib={}, **extra):
-        super(Web, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = NodeBase._weakref_slots
 
 
 class Chunk(SyntaxElement):
-    def __init__(self, attrib={}, **extra):
-        super(Chunk, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = NodeBase._weakref_slots
 
 
 class Text(SyntaxElement):
-    def __init__(self, attrib={}, **extra):
-        super(Text, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class NaturalText(Text):
-    def __init__(self, attrib={}, **extra):
-        super(NaturalText, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class QuotedText(Text):
-    def __init__(self, attrib={}, **extra):
-        super(QuotedText, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 # TODO: Code should inherit QuotedText?
 class Code(Text):
-    def __init__(self, attrib={}, **extra):
-        super(Code, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class Keyword(Text):
-    def __init__(self, attrib={}, **extra):
-        super(Keyword, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class Comment(Text):
-    def __init__(self, attrib={}, **extra):
-        super(Comment, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class SpecialComment(Text):
-    def __init__(self, attrib={}, **extra):
-        super(SpecialComment, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class Literal(Text):
-    def __init__(self, attrib={}, **extra):
-        super(Literal, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class LiteralChar(Text):
-    def __init__(self, attrib={}, **extra):
-        super(LiteralChar, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class LiteralString(Text):
-    def __init__(self, attrib={}, **extra):
-        super(LiteralString, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class LiteralNumber(Text):
-    def __init__(self, attrib={}, **extra):
-        super(LiteralNumber, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class LiteralNumberBin(Text):
-    def __init__(self, attrib={}, **extra):
-        super(LiteralNumberBin, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class LiteralNumberOct(Text):
-    def __init__(self, attrib={}, **extra):
-        super(LiteralNumberOct, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class LiteralNumberDec(Text):
-    def __init__(self, attrib={}, **extra):
-        super(LiteralNumberDec, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class LiteralNumberHex(Text):
-    def __init__(self, attrib={}, **extra):
-        super(LiteralNumberHex, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class LiteralNumberFloat(Text):
-    def __init__(self, attrib={}, **extra):
-        super(LiteralNumberFloat, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class Punctuation(Text):
-    def __init__(self, attrib={}, **extra):
-        super(Punctuation, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class Operator(Code):
-    def __init__(self, attrib={}, **extra):
-        super(Operator, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class WordOperator(Code):
-    def __init__(self, attrib={}, **extra):
-        super(WordOperator, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class CodeEntityName(Code):
-    def __init__(self, attrib={}, **extra):
-        super(CodeEntityName, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class BuiltinCodeEntityName(CodeEntityName):
-    def __init__(self, attrib={}, **extra):
-        super(BuiltinCodeEntityName, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class ClassName(CodeEntityName):
-    def __init__(self, attrib={}, **extra):
-        super(ClassName, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class ConstantName(CodeEntityName):
-    def __init__(self, attrib={}, **extra):
-        super(ConstantName, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class ExceptionName(CodeEntityName):
-    def __init__(self, attrib={}, **extra):
-        super(ExceptionName, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class FunctionName(CodeEntityName):
-    def __init__(self, attrib={}, **extra):
-        super(FunctionName, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class LabelName(CodeEntityName):
-    def __init__(self, attrib={}, **extra):
-        super(LabelName, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class NamespaceName(CodeEntityName):
-    def __init__(self, attrib={}, **extra):
-        super(NamespaceName, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class VariableName(CodeEntityName):
-    def __init__(self, attrib={}, **extra):
-        super(VariableName, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class InteractivePrompt(Code):
-    def __init__(self, attrib={}, **extra):
-        super(InteractivePrompt, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class InteractiveResponse(Code):
-    def __init__(self, attrib={}, **extra):
-        super(InteractiveResponse, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class Annotation(SyntaxElement):
-    def __init__(self, attrib={}, **extra):
-        super(Annotation, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
 
 
 class Use(Annotation):
-    def __init__(self, attrib={}, **extra):
-        super(Use, self).__init__(attrib, **extra)
-        self.tag = self.__class__.__name__
+    __slots__ = ()
+
+
+# Token classes that may appear in a TokenRun. A run stores the index of each
+# token's class in this list, so new classes must be appended at the end.
+token_classes = [
+    Text,
+    NaturalText,
+    QuotedText,
+    Code,
+    Keyword,
+    Comment,
+    SpecialComment,
+    Literal,
+    LiteralChar,
+    LiteralString,
+    LiteralNumber,
+    LiteralNumberBin,
+    LiteralNumberOct,
+    LiteralNumberDec,
+    LiteralNumberHex,
+    LiteralNumberFloat,
+    Punctuation,
+    Operator,
+    WordOperator,
+    CodeEntityName,
+    BuiltinCodeEntityName,
+    ClassName,
+    ConstantName,
+    ExceptionName,
+    FunctionName,
+    LabelName,
+    NamespaceName,
+    VariableName,
+    InteractivePrompt,
+    InteractiveResponse,
+]
+
+token_kinds = dict((cls, kind) for kind, cls in enumerate(token_classes))
+
+
+# A run of lexed tokens stored column-wise: the text of all tokens is kept in
+# one string (the run's text), the class of each token in [kinds] and the
+# boundaries of each token's text in [offsets]. Token elements are only
+# created when the run is iterated or indexed; tokens() yields the classes
+# and texts without creating elements.
+class TokenRun(Text):
+    __slots__ = ('kinds', 'offsets')
+
+    def __init__(self, attrib={}, **extra):
+        super(TokenRun, self).__init__(attrib, **extra)
+        self.kinds = array('B')
+        self.offsets = array('I', [0])
+        if self.text:
+            self.kinds.append(token_kinds[Text])
+            self.offsets.append(len(self.text))
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        result = cls()
+        texts = []
+        pos = 0
+        for token_class, text in tokens:
+            pos += len(text)
+            result.kinds.append(token_kinds[token_class])
+            result.offsets.append(pos)
+            texts.append(text)
+        result.text = ''.join(texts)
+        return result
+
+    def __reduce__(self):
+        return _token_run, (self.__class__, dict(self.items()), self.text, self.kinds, self.offsets)
+
+    def _copy_node(self):
+        result = super(TokenRun, self)._copy_node()
+        result.kinds = array('B', self.kinds)
+        result.offsets = array('I', self.offsets)
+        return result
+
+    def tokens(self):
+        text = self.text
+        offsets = self.offsets
+        for i, kind in enumerate(self.kinds):
+            yield token_classes[kind], text[offsets[i]:offsets[i + 1]]
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __iter__(self):
+        for token_class, text in self.tokens():
+            yield token_class(text=text)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        kind = self.kinds[index]
+        if index < 0:
+            index += len(self.kinds)
+        return token_classes[kind](text=self.text[self.offsets[index]:self.offsets[index + 1]])
+
+
+def _token_run(element_class, attrib, text, kinds, offsets):
+    result = make_node(element_class, attrib, text)
+    result.kinds = kinds
+    result.offsets = offsets
+    return result
+
+
+# Replaces the token runs among a chunk's children by their token elements.
+def expand_token_runs(chunk):
+    if not any(isinstance(child, TokenRun) for child in chunk):
+        return chunk
+
+    result = copy_node(chunk)
+    for child in chunk:
+        if isinstance(child, TokenRun):
+            result.extend(list(child))
+        else:
+            result.append(child)
+    return result
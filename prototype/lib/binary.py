@@ -0,0 +1,274 @@
+from . import ast
+
+from array import array
+from io import BytesIO
+import struct
+import sys
+
+
+# Binary interchange format for syntax trees, used to chain yaweb processes
+# without formatting and re-parsing noweb text in between.
+#
+# A stream starts with MAGIC and continues with one record per top-level
+# node (usually a chunk), each prefixed with its length. Within a stream,
+# strings of up to SYMBOL_MAX characters (class names, attribute keys, short
+# values and short texts such as lexed tokens) are only sent the first time;
+# later occurrences refer to them by index.
+#
+#   node     = symbol:tag  size:n_attrib (symbol:key value)*  value:text
+#              value:tail  children
+#   children = size:n_children node*                   (all other nodes)
+#            | size:n_tokens u8[n]:kinds u32[n+1]:offsets   (TokenRun)
+#   value    = u8:type payload
+#   size     = u8 (< 254) | 254 u16 | 255 u32
+
+MAGIC = b'YAWEB\x00\x01\n'
+
+SYMBOL_MAX = 32
+
+NONE, TRUE, FALSE, INT, BIGINT, FLOAT, STRING, SYMBOL_NEW, SYMBOL, LIST = range(10)
+
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+I64 = struct.Struct('<q')
+F64 = struct.Struct('<d')
+
+node_classes = dict(
+    (name, cls) for name, cls in vars(ast).items() \
+        if isinstance(cls, type) and issubclass(cls, ast.SyntaxElement)
+)
+
+
+def _little_endian(items):
+    if sys.byteorder == 'big':
+        items = array(items.typecode, items)
+        items.byteswap()
+    return items.tobytes()
+
+
+def _pack_size(buf, size):
+    if size < 254:
+        buf.append(size)
+    elif size < (1 << 16):
+        buf.append(254)
+        buf += U16.pack(size)
+    else:
+        buf.append(255)
+        buf += U32.pack(size)
+
+
+class Writer(object):
+    def __init__(self, stream):
+        self.stream  = stream
+        self.symbols = {}
+        self.started = False
+
+    def _start(self):
+        if not self.started:
+            self.stream.write(MAGIC)
+            self.started = True
+
+    def write(self, node):
+        self._start()
+        buf = bytearray()
+        symbols = len(self.symbols)
+        try:
+            self._node(buf, node)
+        except (TypeError, AttributeError):
+            # nothing was written; forget the symbols of the node
+            for value in list(self.symbols)[symbols:]:
+                del self.symbols[value]
+            raise
+        self.stream.write(U32.pack(len(buf)))
+        self.stream.write(buf)
+
+    def close(self):
+        self._start()
+        self.stream.flush()
+
+    def _string(self, buf, value):
+        if len(value) <= SYMBOL_MAX:
+            index = self.symbols.get(value)
+            if index is not None:
+                buf.append(SYMBOL)
+                _pack_size(buf, index)
+                return
+            self.symbols[value] = len(self.symbols)
+            buf.append(SYMBOL_NEW)
+        else:
+            buf.append(STRING)
+        data = value.encode('utf-8')
+        _pack_size(buf, len(data))
+        buf += data
+
+    def _value(self, buf, value):
+        if value is None:
+            buf.append(NONE)
+        elif value is True:
+            buf.append(TRUE)
+        elif value is False:
+            buf.append(FALSE)
+        elif isinstance(value, str):
+            self._string(buf, value)
+        elif isinstance(value, int):
+            if -(1 << 63) <= value < (1 << 63):
+                buf.append(INT)
+                buf += I64.pack(value)
+            else:
+                buf.append(BIGINT)
+                data = str(value).encode('ascii')
+                _pack_size(buf, len(data))
+                buf += data
+        elif isinstance(value, float):
+            buf.append(FLOAT)
+            buf += F64.pack(value)
+        elif isinstance(value, (list, tuple)):
+            buf.append(LIST)
+            _pack_size(buf, len(value))
+            for item in value:
+                self._value(buf, item)
+        else:
+            raise TypeError('cannot serialize %r (type %s)' % (value, type(value).__name__))
+
+    def _node(self, buf, node):
+        self._string(buf, node.tag)
+
+        items = list(node.items())
+        _pack_size(buf, len(items))
+        for key, value in items:
+            self._string(buf, key)
+            self._value(buf, value)
+
+        self._value(buf, node.text)
+        self._value(buf, node.tail)
+
+        if isinstance(node, ast.TokenRun):
+            _pack_size(buf, len(node.kinds))
+            buf += node.kinds.tobytes()
+            buf += _little_endian(node.offsets)
+        else:
+            children = list(node)
+            _pack_size(buf, len(children))
+            for child in children:
+                self._node(buf, child)
+
+
+class Reader(object):
+    def __init__(self, stream):
+        self.stream  = stream
+        self.symbols = []
+        self.data    = b''
+        self.pos     = 0
+
+    def _read(self, size):
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise EOFError('truncated yaweb binary stream')
+        return data
+
+    def __iter__(self):
+        magic = self.stream.read(len(MAGIC))
+        if not magic:
+            return
+        if magic != MAGIC:
+            raise ValueError('not a yaweb binary stream')
+
+        while True:
+            head = self.stream.read(U32.size)
+            if not head:
+                return
+            if len(head) != U32.size:
+                raise EOFError('truncated yaweb binary stream')
+
+            self.data = self._read(U32.unpack(head)[0])
+            self.pos = 0
+            yield self._node()
+
+    def _size(self):
+        size = self.data[self.pos]
+        self.pos += 1
+        if size == 254:
+            size = U16.unpack_from(self.data, self.pos)[0]
+            self.pos += U16.size
+        elif size == 255:
+            size = U32.unpack_from(self.data, self.pos)[0]
+            self.pos += U32.size
+        return size
+
+    def _bytes(self, size):
+        data = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return data
+
+    def _value(self):
+        kind = self.data[self.pos]
+        self.pos += 1
+
+        if kind == SYMBOL:
+            return self.symbols[self._size()]
+        elif kind == SYMBOL_NEW:
+            value = self._bytes(self._size()).decode('utf-8')
+            self.symbols.append(value)
+            return value
+        elif kind == STRING:
+            return self._bytes(self._size()).decode('utf-8')
+        elif kind == NONE:
+            return None
+        elif kind == TRUE:
+            return True
+        elif kind == FALSE:
+            return False
+        elif kind == INT:
+            value = I64.unpack_from(self.data, self.pos)[0]
+            self.pos += I64.size
+            return value
+        elif kind == BIGINT:
+            return int(self._bytes(self._size()).decode('ascii'))
+        elif kind == FLOAT:
+            value = F64.unpack_from(self.data, self.pos)[0]
+            self.pos += F64.size
+            return value
+        elif kind == LIST:
+            return [self._value() for i in range(self._size())]
+        else:
+            raise ValueError('bad value type %d in yaweb binary stream' % kind)
+
+    def _node(self):
+        tag = self._value()
+        if tag not in node_classes:
+            raise ValueError('unknown node type %r in yaweb binary stream' % tag)
+
+        attrib = {}
+        for i in range(self._size()):
+            key = self._value()
+            attrib[key] = self._value()
+
+        node = ast.make_node(node_classes[tag], attrib, self._value())
+        tail = self._value()
+        if tail is not None:
+            node.tail = tail
+
+        if isinstance(node, ast.TokenRun):
+            count = self._size()
+            node.kinds = array('B', self._bytes(count))
+            node.offsets = array('I')
+            node.offsets.frombytes(self._bytes((count + 1) * 4))
+            if sys.byteorder == 'big':
+                node.offsets.byteswap()
+        else:
+            node.extend([self._node() for i in range(self._size())])
+
+        return node
+
+
+def dumps(nodes):
+    stream = BytesIO()
+    writer = Writer(stream)
+    for node in nodes:
+        writer.write(node)
+    writer.close()
+    return stream.getvalue()
+
+
+def loads(data):
+    return list(Reader(BytesIO(data)))
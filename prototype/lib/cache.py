@@ -0,0 +1,322 @@
+from . import binary
+from .incremental import chunk_key, relocate
+
+from collections import OrderedDict
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+# On-disk cache of the results of ContentTools (see ContentTool.cache_key()),
+# shared by all stages and kept from one run to the next. Results are found
+# by a hash of the tool, its cache key and the input chunk (without its
+# location), and stored in the binary interchange format.
+DEFAULT_PATH = '_yaweb_cache.db'
+DEFAULT_MAX_SIZE = 256 << 20
+
+# part of every key; change it when tools produce different results for the
+# same input
+VERSION = 1
+
+
+# Byte strings by key in an SQLite database of at most max_size bytes; the
+# least recently used entries are evicted first. It may be used from any
+# thread (as stages are run by --runner=threads), one at a time, and by
+# several processes at once (e.g. two runs in the same directory): every
+# store is committed right away, in WAL mode, and the uses of the entries
+# that were read are written with the next store or on flush(). Trouble with
+# the database (locked for longer than BUSY_TIMEOUT, unreadable, ...) only
+# costs cache misses.
+BUSY_TIMEOUT = 10.0
+
+
+class DiskCache(object):
+    def __init__(self, path=DEFAULT_PATH, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.lock = threading.RLock()
+        self.used = []      # (time of use, key) of the entries read since the last write
+        self.size = 0
+        self.clock = 0
+
+        # a database that can't be opened is replaced by one in memory
+        try:
+            self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        except sqlite3.DatabaseError:
+            self.errors += 1
+            self.db = sqlite3.connect(':memory:', check_same_thread=False)
+
+        try:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key BLOB PRIMARY KEY, value BLOB NOT NULL, '
+                'size INTEGER NOT NULL, used INTEGER NOT NULL)'
+            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+            self.db.commit()
+
+            # total size of the entries, and the time of the last use
+            # (counted in uses, not seconds)
+            self.size, self.clock = self.db.execute(
+                'SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM entries'
+            ).fetchone()
+        except sqlite3.DatabaseError:
+            self._error()
+
+    def _error(self):
+        self.errors += 1
+        try:
+            self.db.rollback()
+        except sqlite3.DatabaseError:
+            pass
+
+    def get(self, key):
+        with self.lock:
+            try:
+                row = self.db.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            except sqlite3.DatabaseError:
+                self._error()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.clock += 1
+            self.used.append((self.clock, key))
+            return row[0]
+
+    def put(self, key, value):
+        size = len(key) + len(value)
+        if size > self.max_size:
+            return
+
+        with self.lock:
+            self.clock += 1
+            try:
+                self._write_used()
+
+                row = self.db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+                old_size = row[0] if row is not None else 0
+
+                self.db.execute(
+                    'INSERT OR REPLACE INTO entries (key, value, size, used) VALUES (?, ?, ?, ?)',
+                    (key, value, size, self.clock)
+                )
+
+                evicted = []
+                if self.size - old_size + size > self.max_size:
+                    evicted = self._evict(self.size - old_size + size)
+
+                self.db.commit()
+            except sqlite3.DatabaseError:
+                self._error()
+                return
+
+            self.size += size - old_size - sum(evicted_size for evicted_key, evicted_size in evicted)
+            self.stores += 1
+            self.evictions += len(evicted)
+
+    # marks the entries of keys as used, in that order
+    def touch(self, keys):
+        with self.lock:
+            for key in keys:
+                self.clock += 1
+                self.used.append((self.clock, key))
+
+    def _write_used(self):
+        used, self.used = self.used, []
+        if used:
+            self.db.executemany('UPDATE entries SET used = ? WHERE key = ?', used)
+
+    # evicts down to 90% of max_size, so that the next few stores fit;
+    # returns the evicted keys and sizes
+    def _evict(self, total_size):
+        evicted = []
+        for key, size in self.db.execute('SELECT key, size FROM entries ORDER BY used'):
+            if total_size <= self.max_size * 9 // 10:
+                break
+            evicted.append((key, size))
+            total_size -= size
+
+        self.db.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key, size in evicted])
+        return evicted
+
+    def flush(self):
+        with self.lock:
+            try:
+                self._write_used()
+                self.db.commit()
+            except sqlite3.DatabaseError:
+                self._error()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.close()
+
+    def stats(self):
+        return 'cache: %d hits, %d misses, %d stored, %d evicted, %d errors, %d bytes in %s' % (
+            self.hits,
+            self.misses,
+            self.stores,
+            self.evictions,
+            self.errors,
+            self.size,
+            self.path
+        )
+
+
+# The results of eval commands, (return code, output, error output) by
+# command and input, in a DiskCache (opened on first use, so that no file is
+# made for a web without eval tasks) with the most recently used results of
+# at most memory_size bytes in memory in front of it. A result is committed
+# as soon as it is stored; the results taken from memory are marked as used
+# in the DiskCache on flush() (and before a store, which may evict), so that
+# they aren't the first ones evicted from it.
+DEFAULT_EVAL_PATH = '_yaweb_eval.db'
+DEFAULT_EVAL_MEMORY_SIZE = 16 << 20
+
+
+class EvalCache(object):
+    def __init__(self, path=DEFAULT_EVAL_PATH, max_size=DEFAULT_MAX_SIZE, memory_size=DEFAULT_EVAL_MEMORY_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.memory_size = memory_size
+        self.disk = None
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.memory_hits = 0
+        self.touched = []   # the keys of the results taken from memory
+
+    def _disk(self):
+        with self.lock:
+            if self.disk is None:
+                self.disk = DiskCache(self.path, self.max_size)
+            return self.disk
+
+    def get(self, command, input):
+        key = eval_key(command, input)
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                self.touched.append(key)
+                return tuple(json.loads(value.decode('utf-8')))
+
+        value = self._disk().get(key)
+        if value is None:
+            return None
+
+        self._remember(key, value)
+        return tuple(json.loads(value.decode('utf-8')))
+
+    def set(self, command, input, result):
+        key = eval_key(command, input)
+        value = json.dumps(list(result)).encode('utf-8')
+
+        disk = self._disk()
+        self._touch(disk)
+        disk.put(key, value)
+        self._remember(key, value)
+
+    def _touch(self, disk):
+        with self.lock:
+            touched, self.touched = self.touched, []
+        if touched:
+            disk.touch(touched)
+
+    def flush(self):
+        if self.disk is not None:
+            self._touch(self.disk)
+            self.disk.flush()
+
+    def _remember(self, key, value):
+        with self.lock:
+            if key in self.memory:
+                self.memory_used -= len(self.memory.pop(key))
+            self.memory[key] = value
+            self.memory_used += len(value)
+
+            while self.memory_used > self.memory_size:
+                self.memory_used -= len(self.memory.popitem(False)[1])
+
+    def stats(self):
+        disk = self.disk
+        return 'eval cache: %d hits (%d in memory), %d misses, %d stored, %d evicted, %d bytes in %s' % (
+            self.memory_hits + (disk.hits if disk else 0),
+            self.memory_hits,
+            disk.misses if disk else 0,
+            disk.stores if disk else 0,
+            disk.evictions if disk else 0,
+            disk.size if disk else 0,
+            self.path
+        )
+
+
+def eval_key(command, input):
+    digest = hashlib.sha256()
+    digest.update(('%d eval %s\0' % (VERSION, command)).encode('utf-8'))
+    digest.update(input.encode('utf-8'))
+    return digest.digest()
+
+
+def result_key(tool, key, chunk):
+    digest = hashlib.sha256()
+    digest.update(('%d %s.%s %s\0' % (
+        VERSION,
+        type(tool).__module__,
+        type(tool).__name__,
+        key
+    )).encode('utf-8'))
+    digest.update(chunk_key(chunk))
+    return digest.digest()
+
+
+# A result is stored as one byte telling its shape, followed by its chunks.
+UNMODIFIED, REMOVED, SINGLE, LIST = b'u', b'r', b's', b'l'
+
+
+def encode_result(chunk, result):
+    if result is chunk:
+        return UNMODIFIED
+    elif result is None:
+        return REMOVED
+    elif isinstance(result, list):
+        return LIST + binary.dumps(result)
+    else:
+        return SINGLE + binary.dumps([result])
+
+
+# the result for chunk, with the location of chunk
+def decode_result(chunk, value):
+    shape = value[:1]
+    if shape == UNMODIFIED:
+        return chunk
+    elif shape == REMOVED:
+        return None
+
+    outputs = [relocate(output, chunk) for output in binary.loads(value[1:])]
+    if shape == SINGLE:
+        return outputs[0]
+    return outputs
@@ -0,0 +1,163 @@
+from collections.abc import MutableMapping
+import threading
+import weakref
+
+
+# A stable reference to a chunk, for meta data that refers to chunks across
+# fences. A fence may spill a chunk to disk and read it back later as a new
+# object (see SpilledChunks); calling the reference gives the chunk itself as
+# long as it is alive, else reads it back from the fence it was spilled by,
+# and gives None once the chunk is gone. A chunk read back is bound to the
+# reference, so that it is the same object for everyone who holds it.
+class ChunkRef(object):
+    __slots__ = ('ref', 'store', '__weakref__')
+
+    def __init__(self, chunk):
+        self.ref = weakref.ref(chunk)
+        self.store = None
+
+    def __call__(self):
+        with _lock:
+            chunk = self.ref()
+            if chunk is None and self.store is not None:
+                store, offset, size = self.store
+                chunk = store.read(offset, size)
+                self._bind(chunk)
+            return chunk
+
+    def _bind(self, chunk):
+        self.ref = weakref.ref(chunk)
+        _refs[chunk] = self
+
+    def alive(self):
+        return self.store is not None or self.ref() is not None
+
+    # whether anything but the fence holds the chunk
+    def held(self):
+        return self.ref() is not None
+
+    # the chunk was written to store at offset
+    def spill(self, store, offset, size):
+        self.store = (store, offset, size)
+
+    # takes the chunk back from its store
+    def unspill(self):
+        chunk = self()
+        self.store = None
+        return chunk
+
+    # the store is gone before the chunk was taken back
+    def drop(self):
+        self.store = None
+
+
+_refs = weakref.WeakKeyDictionary()
+_lock = threading.RLock()
+
+
+# the ChunkRef of chunk; raises TypeError for nodes that cannot be weakly
+# referenced
+def chunk_ref(chunk):
+    with _lock:
+        ref = _refs.get(chunk)
+        if ref is None:
+            ref = _refs[chunk] = ChunkRef(chunk)
+        return ref
+
+
+# A list of chunks for meta data indexes: like a WeakList, it leaves out the
+# chunks that are gone, but keeps those that are spilled (see ChunkRef).
+class ChunkList(object):
+    def __init__(self, chunks=()):
+        self.refs = [chunk_ref(chunk) for chunk in chunks]
+
+    def _live(self):
+        self.refs = [ref for ref in self.refs if ref.alive()]
+        return self.refs
+
+    def append(self, chunk):
+        self.refs.append(chunk_ref(chunk))
+
+    def extend(self, chunks):
+        for chunk in chunks:
+            self.append(chunk)
+
+    def pop(self, index=-1):
+        return self._live().pop(index)()
+
+    def index(self, chunk):
+        return list(self).index(chunk)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ref() for ref in self._live()[index]]
+        return self._live()[index]()
+
+    def __iter__(self):
+        for ref in list(self.refs):
+            chunk = ref()
+            if chunk is not None:
+                yield chunk
+
+    def __contains__(self, chunk):
+        return any(item is chunk for item in self)
+
+    def __len__(self):
+        return len(self._live())
+
+    def __repr__(self):
+        return "ChunkList(%r)" % list(self)
+
+
+# A mapping keyed by chunks for meta data: like a WeakKeyDictionary, it
+# leaves out the chunks that are gone, but keeps those that are spilled (see
+# ChunkRef).
+class ChunkDictionary(MutableMapping):
+    def __init__(self, items=()):
+        self.data = {}
+        self.limit = 64
+        self.update(items)
+
+    def _purge(self):
+        self.data = dict((ref, value) for ref, value in self.data.items() if ref.alive())
+        self.limit = max(64, 2 * len(self.data))
+
+    def __getitem__(self, chunk):
+        ref = _refs.get(chunk)
+        if ref is None or ref not in self.data:
+            raise KeyError(chunk)
+        return self.data[ref]
+
+    def __setitem__(self, chunk, value):
+        if len(self.data) >= self.limit:
+            self._purge()
+        self.data[chunk_ref(chunk)] = value
+
+    def __delitem__(self, chunk):
+        ref = _refs.get(chunk)
+        if ref is None or ref not in self.data:
+            raise KeyError(chunk)
+        del self.data[ref]
+
+    def __contains__(self, chunk):
+        ref = _refs.get(chunk)
+        return ref is not None and ref in self.data
+
+    def __iter__(self):
+        self._purge()
+        for ref in list(self.data):
+            chunk = ref()
+            if chunk is not None:
+                yield chunk
+
+    def __len__(self):
+        self._purge()
+        return len(self.data)
+
+    # without reading back spilled chunks
+    def values(self):
+        self._purge()
+        return list(self.data.values())
+
+    def __repr__(self):
+        return "ChunkDictionary(%r)" % dict(self.items())
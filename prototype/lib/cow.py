@@ -0,0 +1,159 @@
+from . import ast
+
+from xml.etree import ElementPath
+from xml.etree import ElementTree
+
+import operator
+
+
+# Copy-on-write views of syntax trees. A view is a node of the element's own
+# class (through a subclass of the same name, see _view_class()) with a copy
+# of the element's attributes, text and tail, and with the element's
+# children themselves; a child is replaced by a view of it when the view
+# first hands it out (indexing, iteration, find*(), iter()). So only the
+# nodes on the way to what a hook reads or writes are copied, changing the
+# list of children copies none of them, and every node of the view is a real
+# node that can be mixed with plain ones. unwrap() turns a view back into
+# plain nodes: untouched subtrees are those of the original, the nodes on the
+# paths to a change are copied, and if nothing changed, the original element
+# itself is returned.
+# Reading attributes copies nothing. Nodes that ElementTree finds on its own
+# below a view put into a plain node (e.g. plain.findall('.//Use')) may be
+# the original's, which must not be changed.
+class CopyOnWrite(object):
+    __slots__ = ()
+
+    # the ids of the original's children, which the view still holds until it
+    # hands them out
+    def _shared_ids(self):
+        if self._shared is None:
+            self._shared = set(map(id, _stored_children(self._source)))
+        return self._shared
+
+    def _copy_node(self):
+        return ast.make_node(self._plain, dict(self.items()), self.text)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, index):
+        children = super(CopyOnWrite, self).__getitem__(index)
+        shared = self._shared_ids()
+        if not isinstance(index, slice):
+            if id(children) not in shared:
+                return children
+            result = view(children)
+            super(CopyOnWrite, self).__setitem__(index, result)
+            return result
+
+        if not any(id(child) in shared for child in children):
+            return children
+        if index != slice(None):
+            return [self[i] for i in range(len(self))[index]]
+        children = [view(child) if id(child) in shared else child for child in children]
+        _store_children(self, children)
+        return list(children)
+
+    def iter(self, tag=None):
+        if tag == '*':
+            tag = None
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self:
+            for element in child.iter(tag):
+                yield element
+
+    def find(self, path, namespaces=None):
+        return ElementPath.find(self, path, namespaces)
+
+    def findall(self, path, namespaces=None):
+        return ElementPath.findall(self, path, namespaces)
+
+    def findtext(self, path, default=None, namespaces=None):
+        return ElementPath.findtext(self, path, default, namespaces)
+
+    def iterfind(self, path, namespaces=None):
+        return ElementPath.iterfind(self, path, namespaces)
+
+
+# The children of node as stored, and setting them, without going through a
+# view's methods.
+if ast.NodeBase is ast.CompactNode:
+    def _stored_children(node):
+        return list(ast.CompactNode._children.fget(node))
+
+    def _store_children(node, children):
+        ast.CompactNode._extras(node)[1] = list(children)
+else:
+    def _stored_children(node):
+        return ElementTree.Element.__getitem__(node, slice(None))
+
+    def _store_children(node, children):
+        ElementTree.Element.__setitem__(node, slice(None), children)
+
+
+_view_classes = {}
+
+
+# The subclass of the node class cls for views (or cls, if it is one); named
+# like cls, so that its tag is the same.
+def _view_class(cls):
+    result = _view_classes.get(cls)
+    if result is None:
+        result = type(cls.__name__, (CopyOnWrite, cls), dict(
+            __slots__=('_source', '_shared'),
+            _plain=cls
+        ))
+        _view_classes[cls] = _view_classes[result] = result
+    return result
+
+
+def view(element):
+    # a token run has no child nodes to share
+    if isinstance(element, ast.TokenRun):
+        return ast.copy_node(element)
+
+    cls = _view_classes.get(element.__class__) or _view_class(element.__class__)
+    result = ast.make_node(cls, dict(element.items()), element.text)
+    if element.tail is not None:
+        result.tail = element.tail
+    if len(element):
+        _store_children(result, _stored_children(element))
+    result._source = element
+    result._shared = None
+    return result
+
+
+def unwrap(element):
+    if not isinstance(element, CopyOnWrite):
+        if isinstance(element, ast.TokenRun):
+            return element
+
+        # a plain node of the hook's may hold views
+        for i, child in enumerate(list(element)):
+            result = unwrap(child)
+            if result is not child:
+                element[i] = result
+        return element
+
+    source = element._source
+    children = ()
+    changed = False
+    if len(element) or len(source):
+        children = _stored_children(element)
+        originals = _stored_children(source)
+        if len(children) != len(originals) or any(map(operator.is_not, children, originals)):
+            shared = element._shared_ids()
+            children = [child if id(child) in shared else unwrap(child) for child in children]
+            changed = len(children) != len(originals) or \
+                    any(map(operator.is_not, children, originals))
+
+    if not changed and element.text == source.text and element.tail == source.tail \
+            and element.items() == source.items():
+        return source
+
+    result = ast.make_node(element._plain, dict(element.items()), element.text)
+    if element.tail is not None:
+        result.tail = element.tail
+    result.extend(children)
+    return result
@@ -0,0 +1,77 @@
+from . import ast
+from . import binary
+
+
+# Hands the chunks of a web that is read again back as the objects of the
+# previous run wherever their contents didn't change, so that stages running
+# in incremental mode (see ContentTool and MetaDataTool) recognise them and
+# only process the chunks that changed. Chunks are told apart by their binary
+# serialization and, for equal chunks, the order in which they appear.
+#
+# The location of a chunk in its source file is left out of the comparison,
+# so chunks that only moved (after lines were added or removed above them)
+# are reused as well; their new location is copied over with relocate().
+#
+# meta_changed tells whether a meta chunk was added, changed or removed; the
+# meta code may then have changed what any stage does with any chunk.
+class ChunkReuse(object):
+    def __init__(self):
+        self.chunks = {}
+        self.meta_changed = True
+
+    def __call__(self, chunks):
+        previous, self.chunks = self.chunks, {}
+        self.meta_changed = False
+        counts = {}
+
+        for chunk in chunks:
+            reused = False
+
+            try:
+                key = chunk_key(chunk)
+            except (TypeError, AttributeError):
+                key = None
+
+            if key is not None:
+                counts[key] = counts.get(key, 0) + 1
+                key = (key, counts[key])
+                if key in previous:
+                    chunk = relocate(previous.pop(key), chunk)
+                    reused = True
+                self.chunks[key] = chunk
+
+            if not reused and _is_meta(chunk):
+                self.meta_changed = True
+
+            yield chunk
+
+        if any(_is_meta(chunk) for chunk in previous.values()):
+            self.meta_changed = True
+
+
+# attributes set by the frontends that tell where a chunk was read from; no
+# stage may depend on them in incremental mode
+LOCATION = ('source_line_begin', 'source_line_end')
+
+
+# copies the location of source to chunk (where chunk has one) and returns
+# chunk
+def relocate(chunk, source):
+    for name in LOCATION:
+        value = source.get(name)
+        if value is not None and chunk.get(name) is not None and chunk.get(name) != value:
+            chunk.set(name, value)
+    return chunk
+
+
+# serialization of a chunk without its location
+def chunk_key(chunk):
+    node = ast.copy_node(chunk)
+    for name in LOCATION:
+        node.attrib.pop(name, None)
+    node.extend(list(chunk))
+    return binary.dumps([node])
+
+
+def _is_meta(chunk):
+    return chunk.get('meta') is not None and chunk.get('meta') is not False
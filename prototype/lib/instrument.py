@@ -0,0 +1,209 @@
+from .toolchain import ContentTool, ContentToolHook, Toolchain
+
+import threading
+import time
+import tracemalloc
+
+
+# Counters of one stage. As a hook of a ContentTool, it also counts the
+# chunks the tool removed, added (a replaced chunk counts as both) and passed
+# on unmodified, and charges the time from taking a chunk to handing on its
+# outputs to the tool.
+class StageStats(ContentToolHook):
+    def __init__(self, name):
+        super(StageStats, self).__init__()
+        self.name = name
+        self.profiler = None
+        self.time = 0.0
+        self.alloc = 0
+        self.chunks_in = 0
+        self.chunks_out = 0
+        self.removed = None
+        self.added = None
+        self.unmodified = None
+
+    def before_chunk_process(self, chunk):
+        self.chunks_in += 1
+        self.profiler.enter(self)
+
+    def after_chunk_process(self, chunk):
+        self.profiler.leave()
+
+    def after_chunk_added(self, chunk):
+        self.added += 1
+        self.chunks_out += 1
+
+    def after_chunk_removed(self, chunk):
+        self.removed += 1
+
+    def after_chunk_unmodified(self, chunk):
+        self.unmodified += 1
+        self.chunks_out += 1
+
+
+# Wall time (and, with memory=True, net allocated memory as traced by
+# tracemalloc) spent in each stage of a pipeline, and the chunks going in and
+# out of it. Stages run interleaved as generators, so the time is charged to
+# the stage that is running whenever control passes from one stage to
+# another: pulling a chunk from the stage before charges the time until it
+# arrives to that stage. Each thread keeps a stack of its own, as each stage
+# runs in a thread of its own under --runner=threads; tracemalloc only counts
+# the memory of the whole process, though, so with threads the memory a
+# stage allocated is only a rough figure.
+#
+# The stages are profiled where they are: ContentTools through a StageStats
+# hook, the others (and the stages of nested toolchains, which are taken
+# apart) in a ProfiledStage that the runners and fusion treat as the stage it
+# wraps, so that a profile measures the same pipeline as a run without it.
+class Profiler(object):
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage_stats(self, name):
+        if name not in self.stats:
+            self.stats[name] = StageStats(name)
+        return self.stats[name]
+
+    def _alloc(self):
+        return tracemalloc.get_traced_memory()[0] if self.memory else 0
+
+    # the stack of the current thread
+    def _stack(self):
+        local = self.local
+        if not hasattr(local, 'stack'):
+            local.stack = []
+            local.last_time = time.perf_counter()
+            local.last_alloc = self._alloc()
+        return local.stack
+
+    def _switch(self):
+        stack = self._stack()
+        local = self.local
+
+        now = time.perf_counter()
+        alloc = self._alloc()
+
+        if stack:
+            stats = stack[-1]
+            with self.lock:
+                stats.time += now - local.last_time
+                stats.alloc += alloc - local.last_alloc
+
+        local.last_time = now
+        local.last_alloc = alloc
+
+    def enter(self, stats):
+        self._switch()
+        self._stack().append(stats)
+
+    def leave(self):
+        self._switch()
+        self._stack().pop()
+
+    # the stages, each with its own StageStats (by name from names, a dict
+    # of id(stage) -> name, or by class name)
+    def wrap(self, stages, names={}):
+        result = []
+        for stage in stages:
+            if isinstance(stage, Toolchain):
+                result.extend(self.wrap(stage.stages, names))
+                continue
+
+            stats = self.stage_stats(names.get(id(stage), type(stage).__name__))
+            if isinstance(stage, ContentTool):
+                if stats not in stage.hooks:
+                    stage.hooks = stage.hooks + [stats]
+                stats.profiler = self
+                stats.removed = stats.removed or 0
+                stats.added = stats.added or 0
+                stats.unmodified = stats.unmodified or 0
+                result.append(stage)
+            else:
+                result.append(ProfiledStage(self, stage, stats))
+        return result
+
+    def iterate(self, chunks, stats):
+        self.enter(stats)
+        try:
+            chunks = iter(chunks)
+        finally:
+            self.leave()
+
+        while True:
+            self.enter(stats)
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                self.leave()
+
+            stats.chunks_out += 1
+            yield chunk
+
+    def report(self, stream):
+        stages = sorted(self.stats.values(), key=lambda stats: -stats.time)
+        total = sum(stats.time for stats in stages) or 1.0
+
+        columns = ['stage', 'time/s', '%', 'in', 'out', 'removed', 'added', 'unmodified']
+        if self.memory:
+            columns.append('alloc/KiB')
+
+        rows = []
+        for stats in stages:
+            row = [
+                stats.name,
+                '%.3f' % stats.time,
+                '%.1f' % (100.0 * stats.time / total),
+                str(stats.chunks_in),
+                str(stats.chunks_out),
+                '-' if stats.removed is None else str(stats.removed),
+                '-' if stats.added is None else str(stats.added),
+                '-' if stats.unmodified is None else str(stats.unmodified),
+            ]
+            if self.memory:
+                row.append('%.1f' % (stats.alloc / 1024.0))
+            rows.append(row)
+        rows.append(['total', '%.3f' % total] + [''] * (len(columns) - 2))
+
+        widths = [max(len(row[i]) for row in [columns] + rows) for i in range(len(columns))]
+        for row in [columns] + rows:
+            cells = [row[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]
+            stream.write('  '.join(cells).rstrip() + '\n')
+
+
+# A stage of a Toolchain that charges the work it does to its StageStats. It
+# reports the class of the stage, so that isinstance() checks of the runners
+# see the stage itself.
+class ProfiledStage(object):
+    def __init__(self, profiler, stage, stats):
+        self.profiler = profiler
+        self.stage = stage
+        self.stats = stats
+
+    @property
+    def __class__(self):
+        return self.stage.__class__
+
+    def __getattr__(self, name):
+        return getattr(self.stage, name)
+
+    def _count(self, chunks):
+        for chunk in chunks:
+            self.stats.chunks_in += 1
+            yield chunk
+
+    def pipe(self, chunks, meta_data):
+        self.profiler.enter(self.stats)
+        try:
+            chunks, meta_data = self.stage.pipe(self._count(chunks), meta_data)
+        finally:
+            self.profiler.leave()
+
+        return self.profiler.iterate(chunks, self.stats), meta_data
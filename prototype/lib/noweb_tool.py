@@ -2,14 +2,37 @@ from . import ast
 from . import regex
 from .textutils import escape_chars
 
+from collections import deque
+from functools import lru_cache
+import codecs
+import io
+import mmap
+import os
 import re
+import stat
 
 
 class Token(object):
-    pass
+    __slots__ = ()
+
+
+class ArglessToken(Token):
+    # tokens without arguments are immutable, so all tokens of the same class
+    # share one instance
+    __slots__ = ()
+    instances = {}
+
+    def __new__(cls):
+        instance = ArglessToken.instances.get(cls)
+        if instance is None:
+            instance = super(ArglessToken, cls).__new__(cls)
+            ArglessToken.instances[cls] = instance
+        return instance
 
 
 class FileToken(Token):
+    __slots__ = ('file_name',)
+
     def __init__(self, file_name):
         self.file_name = file_name
 
@@ -23,6 +46,8 @@ class FileToken(Token):
 
 
 class BeginDocsToken(Token):
+    __slots__ = ('chunk_id',)
+
     def __init__(self, chunk_id):
         self.chunk_id = chunk_id
 
@@ -36,6 +61,8 @@ class BeginDocsToken(Token):
 
 
 class EndDocsToken(Token):
+    __slots__ = ('chunk_id',)
+
     def __init__(self, chunk_id):
         self.chunk_id = chunk_id
 
@@ -49,6 +76,8 @@ class EndDocsToken(Token):
 
 
 class BeginCodeToken(Token):
+    __slots__ = ('chunk_id',)
+
     def __init__(self, chunk_id):
         self.chunk_id = chunk_id
 
@@ -62,6 +91,8 @@ class BeginCodeToken(Token):
 
 
 class EndCodeToken(Token):
+    __slots__ = ('chunk_id',)
+
     def __init__(self, chunk_id):
         self.chunk_id = chunk_id
 
@@ -75,6 +106,8 @@ class EndCodeToken(Token):
 
 
 class DefnToken(Token):
+    __slots__ = ('chunk_name',)
+
     def __init__(self, chunk_name):
         self.chunk_name = chunk_name
 
@@ -88,6 +121,8 @@ class DefnToken(Token):
 
 
 class UseToken(Token):
+    __slots__ = ('chunk_name',)
+
     def __init__(self, chunk_name):
         self.chunk_name = chunk_name
 
@@ -101,11 +136,15 @@ class UseToken(Token):
 
 
 class ChunkOptionsToken(Token):
+    __slots__ = ('options',)
+
     def __init__(self, options):
         self.options = options
 
 
 class TextToken(Token):
+    __slots__ = ('text', 'tags')
+
     def __init__(self, text, tags=None):
         self.text = text
         self.tags = tags
@@ -128,7 +167,9 @@ class TextToken(Token):
             )
 
 
-class BeginQuoteToken(Token):
+class BeginQuoteToken(ArglessToken):
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -139,7 +180,9 @@ class BeginQuoteToken(Token):
         return r'BeginQuoteToken()'
 
 
-class EndQuoteToken(Token):
+class EndQuoteToken(ArglessToken):
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -151,6 +194,8 @@ class EndQuoteToken(Token):
 
 
 class LiteralToken(Token):
+    __slots__ = ('text',)
+
     def __init__(self, text):
         self.text = text
 
@@ -163,7 +208,9 @@ class LiteralToken(Token):
         )
 
 
-class NewlineToken(Token):
+class NewlineToken(ArglessToken):
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -175,6 +222,8 @@ class NewlineToken(Token):
 
 
 class UnknownToken(Token):
+    __slots__ = ('token_id', 'args')
+
     def __init__(self, token_id, args=None):
         self.token_id = token_id
         self.args = args
@@ -189,6 +238,134 @@ class UnknownToken(Token):
         )
 
 
+class InputBuffer(object):
+    # Holds the whole input as one string and splits lines from it. Besides
+    # the readline() interface expected by Lexer, readspan() returns the
+    # extent of the next line (without its line break) so that a lexer can
+    # work on the buffer directly instead of on a copy of every line.
+    def __init__(self, text):
+        self.buffer = text
+        self.pos    = 0
+
+    def readspan(self):
+        begin = self.pos
+        if begin >= len(self.buffer):
+            return None
+
+        end = self.buffer.find('\n', begin)
+        if end < 0:
+            end = len(self.buffer)
+            self.pos = end
+        else:
+            self.pos = end + 1
+
+        return begin, end
+
+    def readline(self):
+        span = self.readspan()
+        if span is None:
+            return ''
+        return self.buffer[span[0]:self.pos]
+
+    # the rest of the input
+    def read(self):
+        begin, self.pos = self.pos, len(self.buffer)
+        return self.buffer[begin:]
+
+
+class MappedInput(InputBuffer):
+    # Input from a memory-mapped file, decoded block_size bytes at a time as
+    # the lines are read. The buffer holds the decoded part that hasn't been
+    # read yet; a line that isn't complete in it is completed from the next
+    # block before it is handed out.
+    def __init__(self, mapping, encoding, block_size=1 << 20):
+        super(MappedInput, self).__init__('')
+        self.mapping    = mapping
+        self.decoder    = _text_decoder(encoding)
+        self.block_size = block_size
+        self.offset     = 0
+        self.last_break = -1
+
+    def _decode_block(self):
+        block = self.mapping[self.offset:self.offset + self.block_size]
+        self.offset += len(block)
+
+        final = self.offset >= len(self.mapping)
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(block, final)
+        self.pos = 0
+        self.last_break = self.buffer.rfind('\n')
+
+        if final:
+            self.mapping.close()
+
+    def readspan(self):
+        while self.pos > self.last_break and not self.mapping.closed:
+            self._decode_block()
+        return super(MappedInput, self).readspan()
+
+    def read(self):
+        while not self.mapping.closed:
+            self._decode_block()
+        return super(MappedInput, self).read()
+
+
+# Decodes bytes the way a file opened in text mode does, i.e. with universal
+# newlines: \r\n and \r become \n.
+def _text_decoder(encoding):
+    return io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), True)
+
+
+def read_buffered(stream, block_size=1 << 20):
+    raw = getattr(stream, 'buffer', stream)
+
+    blocks = []
+    block = raw.read(block_size)
+    while block:
+        blocks.append(block)
+        block = raw.read(block_size)
+
+    if blocks and isinstance(blocks[0], bytes):
+        encoding = getattr(stream, 'encoding', None) or 'utf-8'
+        return InputBuffer(_text_decoder(encoding).decode(b''.join(blocks), True))
+    else:
+        return InputBuffer(''.join(blocks))
+
+
+def read_mapped(file, encoding='utf-8', block_size=1 << 20):
+    if isinstance(file, str):
+        with open(file, 'rb') as f:
+            return read_mapped(f, encoding, block_size)
+
+    # pipes and terminals cannot be mapped, and neither can empty files
+    info = os.fstat(file.fileno())
+    if not stat.S_ISREG(info.st_mode):
+        return read_buffered(file, block_size)
+    if info.st_size == 0:
+        return InputBuffer('')
+
+    encoding = getattr(file, 'encoding', None) or encoding
+
+    mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return MappedInput(mapping, encoding, block_size)
+
+
+def split_files(text):
+    # Splits a noweb stream into sections that begin with an @file line
+    # (except, possibly, the first one). Since the parser forgets its state
+    # at each @file, the sections can be lexed and parsed independently.
+    sections = []
+    begin = 0
+    pos = text.find('\n@file ')
+    while pos >= 0:
+        if pos + 1 > begin:
+            sections.append(text[begin:pos + 1])
+        begin = pos + 1
+        pos = text.find('\n@file ', begin)
+    if begin < len(text):
+        sections.append(text[begin:])
+    return sections
+
+
 class Lexer(object):
     def __init__(self, stream, extended_syntax=False):
         # static data
@@ -220,14 +397,14 @@ class Lexer(object):
         self.in_chunk_options   = False
         self.in_tagged_text     = False
 
-        self.token_queue    = []
+        self.token_queue    = deque()
 
     def __iter__(self):
         return self
 
     def __next__(self):
         if self.token_queue:
-            return self.token_queue.pop(0)
+            return self.token_queue.popleft()
 
         line = self.stream.readline()
 
@@ -273,46 +450,12 @@ class Lexer(object):
         elif self.extended_syntax \
                 and ((self.at_chunk_options and Re.search(self.TOK_OPTS, line))
                         or (self.in_chunk_options and Re.search(self.TOK_OPTS_CONT, line))):
-            self.at_chunk_options = False
-            if Re.match.group('text') is not None:
-                self.in_chunk_options = False
-                text = Re.match.group('text')
-                if text:
-                    self.token_queue.append(TextToken(text))
-            else:
-                self.in_chunk_options = True
-            return ChunkOptionsToken(Re.match.group('options'))
+            return self._chunk_options(Re.match)
 
         elif self.extended_syntax \
                 and ((not self.in_tagged_text and Re.search(self.TOK_TAGGED, line))
                         or (self.in_tagged_text and Re.search(self.TOK_TAGGED_CONT, line))):
-            self.at_chunk_options = False
-            self.in_tagged_text = False
-
-            if 'pre_text' in Re.match.groupdict():
-                text = Re.match.group('pre_text')
-                text = escape_chars(r'@', r'[@]', text)
-                self.token_queue.append(TextToken(text))
-
-            if 'tags' in Re.match.groupdict():
-                tags = Re.match.group('tags')
-                tags = escape_chars(r'@', r'[@\[\]]', tags)
-                text = Re.match.group('text')
-                text = escape_chars(r'@', r'[@\[\]]', text)
-                self.token_queue.append(TextToken(text, tags))
-            else:
-                # TODO: should re-use the tags we started with
-                pass
-
-            if Re.match.group('post_text') is not None:
-                self.in_tagged_text = False
-                text = Re.match.group('post_text')
-                if text:
-                    self.token_queue.append(TextToken(text))
-            else:
-                self.in_tagged_text = True
-
-            return self.token_queue.pop(0)
+            return self._tagged_text(Re.match)
 
         elif Re.search(self.TOK_TEXT, line):
             self.at_chunk_options = False
@@ -339,6 +482,290 @@ class Lexer(object):
     def next(self):
         return self.__next__()
 
+    def _chunk_options(self, match):
+        self.at_chunk_options = False
+        if match.group('text') is not None:
+            self.in_chunk_options = False
+            text = match.group('text')
+            if text:
+                self.token_queue.append(TextToken(text))
+        else:
+            self.in_chunk_options = True
+        return ChunkOptionsToken(match.group('options'))
+
+    def _tagged_text(self, match):
+        self.at_chunk_options = False
+        self.in_tagged_text = False
+
+        if 'pre_text' in match.groupdict():
+            text = match.group('pre_text')
+            text = escape_chars(r'@', r'[@]', text)
+            self.token_queue.append(TextToken(text))
+
+        if 'tags' in match.groupdict():
+            tags = match.group('tags')
+            tags = escape_chars(r'@', r'[@\[\]]', tags)
+            text = match.group('text')
+            text = escape_chars(r'@', r'[@\[\]]', text)
+            self.token_queue.append(TextToken(text, tags))
+        else:
+            # TODO: should re-use the tags we started with
+            pass
+
+        if match.group('post_text') is not None:
+            self.in_tagged_text = False
+            text = match.group('post_text')
+            if text:
+                self.token_queue.append(TextToken(text))
+        else:
+            self.in_tagged_text = True
+
+        return self.token_queue.popleft()
+
+
+class DispatchLexer(Lexer):
+    # Emits the same token stream as Lexer, but looks at the keyword of each
+    # line only once and jumps to its handler through a table. The regular
+    # expressions are only used for the extended @text syntax and for tokens
+    # that are not well-formed.
+    def __init__(self, stream, extended_syntax=False):
+        super(DispatchLexer, self).__init__(stream, extended_syntax)
+
+        self.spans = hasattr(stream, 'readspan')
+        self.line_span = None
+
+        self.handlers = {
+            'file':     self._lex_file,
+            'begin':    self._lex_begin,
+            'end':      self._lex_end,
+            'defn':     self._lex_defn,
+            'use':      self._lex_use,
+            'quote':    self._lex_begin_quote,
+            'endquote': self._lex_end_quote,
+            'text':     self._lex_text,
+            'literal':  self._lex_literal,
+            'nl':       self._lex_nl,
+        }
+
+    def __next__(self):
+        if self.token_queue:
+            return self.token_queue.popleft()
+
+        # input buffers hand out the extent of each line, so that only the
+        # arguments of a token are ever copied out of the buffer
+        if self.spans:
+            span = self.stream.readspan()
+            if span is None:
+                raise StopIteration()
+            buf = self.stream.buffer
+            begin, end = span
+        else:
+            buf = self.stream.readline()
+            if not buf:
+                raise StopIteration()
+            begin = 0
+            end = len(buf) - 1 if buf.endswith('\n') else len(buf)
+
+        self.internal_lineno += 1
+
+        if buf.startswith('@', begin, end):
+            space = buf.find(' ', begin + 1, end)
+            if space < 0:
+                keyword = buf[begin + 1:end]
+                args = None
+            else:
+                keyword = buf[begin + 1:space]
+                args = buf[space + 1:end]
+
+            self.line_span = (buf, begin, end)
+
+            handler = self.handlers.get(keyword)
+            if handler is not None:
+                token = handler(args)
+                if token is not None:
+                    return token
+
+            return self._lex_unknown()
+
+        else:
+            #raise NowebSyntaxError(self.internal_lineno)
+            raise SyntaxError()
+
+    def _line(self):
+        # some of the regular expressions match the line break, too
+        buf, begin, end = self.line_span
+        return buf[begin:end + 1]
+
+    def _lex_file(self, args):
+        if args is not None:
+            self.at_chunk_options = False
+            return FileToken(args)
+
+    def _lex_begin(self, args):
+        if args is not None:
+            kind, _, chunk_id = args.partition(' ')
+            if chunk_id.isdigit() and chunk_id.isascii():
+                if kind == 'docs':
+                    self.at_chunk_options = True
+                    return BeginDocsToken(chunk_id)
+                elif kind == 'code':
+                    self.at_chunk_options = True
+                    return BeginCodeToken(chunk_id)
+
+    def _lex_end(self, args):
+        if args is not None:
+            kind, _, chunk_id = args.partition(' ')
+            if chunk_id.isdigit() and chunk_id.isascii():
+                if kind == 'docs':
+                    self.at_chunk_options = False
+                    return EndDocsToken(chunk_id)
+                elif kind == 'code':
+                    self.at_chunk_options = False
+                    return EndCodeToken(chunk_id)
+
+    def _lex_defn(self, args):
+        if args is not None:
+            self.at_chunk_options = True
+            return DefnToken(args)
+
+    def _lex_use(self, args):
+        if args is not None:
+            self.at_chunk_options = False
+            return UseToken(args)
+
+    def _lex_begin_quote(self, args):
+        if args is None:
+            self.at_chunk_options = False
+            return BeginQuoteToken()
+
+    def _lex_end_quote(self, args):
+        if args is None:
+            self.at_chunk_options = False
+            return EndQuoteToken()
+
+    def _lex_text(self, args):
+        if args is None:
+            return None
+
+        if self.extended_syntax:
+            # cheap tests first: chunk options have to start with `@[' and
+            # tagged text needs at least one `['
+            if self.at_chunk_options and args.startswith('@['):
+                match = self.TOK_OPTS.search(self._line())
+                if match:
+                    return self._chunk_options(match)
+            if self.in_chunk_options:
+                match = self.TOK_OPTS_CONT.search(self._line())
+                if match:
+                    return self._chunk_options(match)
+
+            if not self.in_tagged_text and '[' in args:
+                match = self.TOK_TAGGED.search(self._line())
+                if match:
+                    return self._tagged_text(match)
+            if self.in_tagged_text:
+                match = self.TOK_TAGGED_CONT.search(self._line())
+                if match:
+                    return self._tagged_text(match)
+
+        self.at_chunk_options = False
+        return TextToken(args)
+
+    def _lex_literal(self, args):
+        if args is not None:
+            self.at_chunk_options = False
+            return LiteralToken(args)
+
+    def _lex_nl(self, args):
+        if args is None:
+            return NewlineToken()
+
+    def _lex_unknown(self):
+        match = self.TOK_UNKNOWN.search(self._line())
+        if match:
+            self.at_chunk_options = False
+            return UnknownToken(**match.groupdict())
+        else:
+            #raise NowebSyntaxError(self.internal_lineno)
+            raise SyntaxError()
+
+
+class TextBuilder(object):
+    # Collects the text fragments appended to an element and joins them once,
+    # when the element is complete. Extending element.text fragment by
+    # fragment takes quadratic time for long chunks.
+    def __init__(self):
+        self.element   = None
+        self.fragments = []
+
+    def append(self, element, text):
+        if element is not self.element:
+            self.flush()
+            self.element = element
+            self.fragments.append(element.text)
+        self.fragments.append(text)
+
+    def flush(self):
+        if self.element is not None:
+            self.element.text = ''.join(self.fragments)
+            self.element   = None
+            self.fragments = []
+
+
+OPT_DELIMED = re.compile(r'(?P<option>(?:[^@,]|@.)+)')
+OPT_KEYVAL  = re.compile(r'^(?:\s*(?P<key>(?:[^@=\s]|@.)+)\s*)(=(?P<val>(?:[^@=]|@.)+))?$')
+OPT_VALUE   = re.compile(r'^(?P<value>.+)$')
+
+
+def _option_value(value):
+    if value in ['true', 'on', 'yes']:
+        return True
+    elif value in ['false', 'off', 'no']:
+        return False
+    else:
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return value
+
+
+# Webs repeat the same option strings over and over, so the results are
+# cached by the raw option string. The result is a tuple of (key, value)
+# pairs, so that callers cannot modify the cached entries.
+@lru_cache(maxsize=4096)
+def parse_chunk_options(options_text):
+    options = dict()
+
+    for match in OPT_DELIMED.finditer(options_text):
+        option = match.group('option')
+        option = escape_chars(r'@', r'[,\]]', option)
+        match_keyval = OPT_KEYVAL.search(option)
+        if match_keyval:
+            key = escape_chars(r'@', r'[@=\s]', match_keyval.group('key'))
+            val = match_keyval.group('val')
+            if val is not None:
+                values = []
+
+                for value in OPT_VALUE.finditer(val):
+                    value = escape_chars(r'@', r'[@]', value.group('value'))
+                    values.append(_option_value(value))
+
+                if len(values) == 0:
+                    options[key] = None
+                elif len(values) == 1:
+                    options[key] = values[0]
+                else:
+                    options[key] = values
+            else:
+                options[key] = ''
+        else:
+            raise SyntaxError()
+
+    return tuple(options.items())
+
 
 class Parser(object):
     def __init__(self, lexer):
@@ -349,6 +776,7 @@ class Parser(object):
         cur_line  = None
         cur_chunk = None
         cur_quote = None
+        cur_text  = TextBuilder()
 
         # parser state
         discard_newlines = False
@@ -358,6 +786,7 @@ class Parser(object):
                 cur_file  = token.file_name
                 cur_line  = 1
                 cur_chunk = None
+                cur_text  = TextBuilder()
                 discard_newlines = False
 
             elif isinstance(token, BeginDocsToken):
@@ -369,6 +798,7 @@ class Parser(object):
                 discard_newlines = False
 
             elif isinstance(token, EndDocsToken):
+                cur_text.flush()
                 self._parse_chunk_opts(cur_chunk)
                 cur_chunk.set('source_line_end', str(cur_line - 1))
                 discard_newlines = False
@@ -384,6 +814,7 @@ class Parser(object):
                 discard_newlines = False
 
             elif isinstance(token, EndCodeToken):
+                cur_text.flush()
                 self._parse_chunk_opts(cur_chunk)
                 cur_chunk.set('source_line_end', str(cur_line - 1))
                 discard_newlines = False
@@ -398,12 +829,14 @@ class Parser(object):
                 if isinstance(token, TextToken):
                     if token.tags is None:
                         if cur_quote is not None:
-                            cur_quote += token.text
+                            cur_quote.append(token.text)
                         elif len(cur_chunk) and type(cur_chunk[-1]) == ast.Text:
-                            cur_chunk[-1].text += token.text
+                            cur_text.append(cur_chunk[-1], token.text)
                         else:
+                            cur_text.flush()
                             cur_chunk.append(ast.Text(text=token.text))
                     else:
+                        cur_text.flush()
                         cur_chunk.append(ast.QuotedText(text=token.text, tags=token.tags))
                     discard_newlines = False
 
@@ -417,83 +850,50 @@ class Parser(object):
                     discard_newlines = True
 
                 elif isinstance(token, UseToken):
+                    cur_text.flush()
                     cur_chunk.append(ast.Use(chunk_name=token.chunk_name))
                     discard_newlines = False
 
                 elif isinstance(token, NewlineToken):
                     if not discard_newlines:
                         if cur_quote is not None:
-                            cur_quote += '\n'
+                            cur_quote.append('\n')
                         elif len(cur_chunk) and isinstance(cur_chunk[-1], ast.Text):
-                            cur_chunk[-1].text += '\n'
+                            cur_text.append(cur_chunk[-1], '\n')
                         else:
+                            cur_text.flush()
                             cur_chunk.append(ast.Text(text='\n'))
                     cur_line += 1
 
                 elif isinstance(token, BeginQuoteToken):
-                    cur_quote = ''
+                    cur_quote = []
                     discard_newlines = False
 
                 elif isinstance(token, EndQuoteToken):
-                    cur_chunk.append(ast.QuotedText(text=cur_quote[:]))
+                    cur_text.flush()
+                    cur_chunk.append(ast.QuotedText(text=''.join(cur_quote)))
                     cur_quote = None
                     discard_newlines = False
 
+        cur_text.flush()
+
         if cur_chunk:
             chunk = cur_chunk
             cur_chunk = None
             yield chunk
 
     def _parse_chunk_opts(self, chunk):
-        options = dict()
-
-        OPT_DELIMED = re.compile(r'(?P<option>(?:[^@,]|@.)+)')
-        OPT_KEYVAL  = re.compile(r'^(?:\s*(?P<key>(?:[^@=\s]|@.)+)\s*)(=(?P<val>(?:[^@=]|@.)+))?$')
-
-        for match in re.finditer(OPT_DELIMED, chunk.get('options', '')):
-            option = match.group('option')
-            option = escape_chars(r'@', r'[,\]]', option)
-            match_keyval = re.search(OPT_KEYVAL, option)
-            if match_keyval:
-                key = escape_chars(r'@', r'[@=\s]', match_keyval.group('key'))
-                val = match_keyval.group('val')
-                if val is not None:
-                    values = []
-
-                    for value in re.finditer(r'^(?P<value>.+)$', val):
-                        value = escape_chars(r'@', r'[@]', value.group('value'))
-
-                        if value in ['true', 'on', 'yes']:
-                            values.append(True)
-                        elif value in ['false', 'off', 'no']:
-                            values.append(False)
-                        else:
-                            try:
-                                values.append(int(value))
-                            except ValueError:
-                                try:
-                                    values.append(float(value))
-                                except ValueError:
-                                    values.append(value)
-
-                    if len(values) == 0:
-                        options[key] = None
-                    elif len(values) == 1:
-                        options[key] = values[0]
-                    else:
-                        options[key] = values
-                else:
-                    options[key] = ''
-            else:
-                raise SyntaxError()
+        options = parse_chunk_options(chunk.get('options', ''))
 
-        for key, value in options.items():
+        for key, value in options:
+            if isinstance(value, list):
+                value = list(value)
             chunk.set(key, value)
 
         if chunk.get('options'):
             chunk.attrib.pop('options')
 
-        return options
+        return dict(options)
 
 
 def simplify(tokens):
@@ -506,9 +906,9 @@ def simplify(tokens):
         #elif isinstance(token, LiteralToken) and token.text == '':
         #    continue
         if result and isinstance(result[-1], TextToken) and isinstance(token, TextToken):
-            result[-1].text += token.text[:]
+            result[-1] = TextToken(result[-1].text + token.text, result[-1].tags)
         elif result and isinstance(result[-1], LiteralToken) and isinstance(token, LiteralToken):
-            result[-1].text += token.text[:]
+            result[-1] = LiteralToken(result[-1].text + token.text)
         else:
-            result.append(eval(repr(token)))
+            result.append(token)
     return result
@@ -0,0 +1,378 @@
+from . import toolchain
+
+import asyncio
+import queue as queues
+import threading
+import time
+
+
+# Async execution of a pipeline (Toolchain.configure(runner='async')). Every
+# stage runs as a coroutine that takes its input from a queue and puts its
+# output into the next one, with at most QUEUE_SIZE items in each queue; the
+# event loop runs while the output is pulled. An item is a pair (seq,
+# chunks): the output chunks of the seq-th batch of at most BATCH chunks that
+# went into the pipeline (or came out of the last fence).
+#
+# ContentTools that don't depend on the order of the chunks take them as they
+# come. Where such a tool has to wait for a chunk (ContentTool.pending(), e.g.
+# for an eval result), the batches behind it go on ahead, at most WINDOW of
+# them; stages that depend on the order get their input back in order, and so
+# does the consumer of the output. MetaDataTools and SideEffectsTools are fed
+# one chunk at a time; any other stage (and ContentTools that use worker
+# processes) runs in a thread of its own.
+BATCH = 16
+QUEUE_SIZE = 16
+WINDOW = 64
+
+END = None
+
+
+# an exception raised by a stage, passed on to the end of the pipeline
+class Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+# (queue statistics are only kept by the threaded runner)
+def run_async(stages, chunks, meta_data, stats=None):
+    loop = asyncio.new_event_loop()
+
+    queue = asyncio.Queue(QUEUE_SIZE)
+    coroutines = [_guard(_source(chunks, queue), queue)]
+    for stage in stages:
+        coroutine, queue, meta_data = _stage(loop, stage, queue, meta_data)
+        coroutines.append(_guard(coroutine, queue))
+
+    return _drain(loop, coroutines, queue), meta_data
+
+
+def _stage(loop, stage, queue, meta_data):
+    output = asyncio.Queue(QUEUE_SIZE)
+
+    if isinstance(stage, toolchain.ContentTool) and not stage._parallel():
+        return _content_tool(stage, queue, output, meta_data), output, meta_data
+
+    elif isinstance(stage, toolchain.Fence):
+        return _fence(stage, queue, output, meta_data), output, meta_data
+
+    elif isinstance(stage, (toolchain.MetaDataTool, toolchain.SideEffectsTool)):
+        feeder = Feeder()
+        chunks, meta_data = stage.pipe(feeder, meta_data)
+        return _one_by_one(feeder, chunks, queue, output), output, meta_data
+
+    else:
+        input = ThreadInput(loop)
+        chunks, meta_data = stage.pipe(input, meta_data)
+        return _thread(loop, input, chunks, queue, output), output, meta_data
+
+
+# on an exception, passes it on instead of the end of the output
+async def _guard(coroutine, output):
+    try:
+        await coroutine
+    except Exception as error:
+        await output.put(Failure(error))
+
+
+# the chunks in batches
+def _batches(chunks):
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) == BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _source(chunks, output):
+    for seq, batch in enumerate(_batches(chunks)):
+        await output.put((seq, batch))
+    await output.put(END)
+
+
+# the items from queue until its end, in order if ordered
+async def _received(queue, ordered):
+    held_back = {}
+    next_seq = 0
+
+    while True:
+        item = await queue.get()
+        if item is END:
+            return
+        if isinstance(item, Failure):
+            raise item.error
+
+        if not ordered:
+            yield item
+            continue
+
+        held_back[item[0]] = item
+        while next_seq in held_back:
+            yield held_back.pop(next_seq)
+            next_seq += 1
+
+
+def _process(tool, chunks, meta_data, replay):
+    outputs = []
+    for chunk in chunks:
+        outputs.extend(tool._finish(chunk, tool._result(chunk, meta_data, replay)))
+    return outputs
+
+
+async def _content_tool(tool, queue, output, meta_data):
+    replay = tool._start()
+    ordered = tool.stateful and not tool.unordered
+
+    # items held up by a pending chunk, by seq
+    waiting = {}
+
+    async def finish(seq, chunks, futures):
+        for future in futures:
+            await asyncio.wrap_future(future)
+        await output.put((seq, _process(tool, chunks, meta_data, replay)))
+
+    async for seq, chunks in _received(queue, ordered):
+        for done in [seq_ for seq_, task in waiting.items() if task.done()]:
+            waiting.pop(done).result()
+        while waiting and seq - min(waiting) >= WINDOW:
+            await waiting.pop(min(waiting))
+
+        futures = [future for future in (tool.pending(chunk, meta_data) for chunk in chunks) \
+                if future is not None and not future.done()]
+        if futures and not ordered:
+            waiting[seq] = asyncio.ensure_future(finish(seq, chunks, futures))
+        else:
+            await finish(seq, chunks, futures)
+
+    for seq in sorted(waiting):
+        await waiting.pop(seq)
+    await output.put(END)
+
+
+async def _fence(fence, queue, output, meta_data):
+    chunks = []
+    async for seq, items in _received(queue, True):
+        chunks.extend(items)
+
+    chunks, meta_data = fence.pipe(toolchain.PopOnIteration(chunks), meta_data)
+    for seq, batch in enumerate(_batches(chunks)):
+        await output.put((seq, batch))
+    await output.put(END)
+
+
+# The input of a stage that takes one chunk and passes it on before it takes
+# the next, as MetaDataTools and SideEffectsTools do.
+class Feeder(object):
+    def __init__(self):
+        self.chunks = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.chunks:
+            raise StopIteration
+        return self.chunks.pop()
+
+
+async def _one_by_one(feeder, chunks, queue, output):
+    async for seq, items in _received(queue, True):
+        outputs = []
+        for chunk in items:
+            feeder.chunks.append(chunk)
+            outputs.append(next(chunks))
+        await output.put((seq, outputs))
+
+    # the stage sees the end of its input
+    for chunk in chunks:
+        raise RuntimeError('stage produced a chunk after the end of its input')
+    await output.put(END)
+
+
+# The input of a stage running in a thread, taken from a queue of the event
+# loop.
+class ThreadInput(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = asyncio.run_coroutine_threadsafe(self.queue.get(), self.loop).result()
+        if chunk is END:
+            raise StopIteration
+        return chunk
+
+
+async def _thread(loop, input, chunks, queue, output):
+    def put(item):
+        asyncio.run_coroutine_threadsafe(output.put(item), loop).result()
+
+    def run():
+        try:
+            for seq, batch in enumerate(_batches(chunks)):
+                put((seq, batch))
+        except Exception as error:
+            put(Failure(error))
+        else:
+            put(END)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    async for seq, items in _received(queue, True):
+        for chunk in items:
+            await input.queue.put(chunk)
+    await input.queue.put(END)
+
+
+# all items in queue, at least one
+async def _take(queue):
+    items = [await queue.get()]
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def _drain(loop, coroutines, queue):
+    tasks = [loop.create_task(coroutine) for coroutine in coroutines]
+    held_back = {}
+    next_seq = 0
+
+    try:
+        while True:
+            for item in loop.run_until_complete(_take(queue)):
+                if item is END:
+                    return
+                if isinstance(item, Failure):
+                    raise item.error
+
+                held_back[item[0]] = item[1]
+                while next_seq in held_back:
+                    for chunk in held_back.pop(next_seq):
+                        yield chunk
+                    next_seq += 1
+    finally:
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+
+
+# Threaded execution of a pipeline (Toolchain.configure(runner='threads')).
+# Every stage runs its own pipe() in a thread of its own and hands its output
+# on in batches of BATCH chunks through a HandOff queue of at most QUEUE_SIZE
+# batches. The chunks stay in order; the stages overlap where they wait (for
+# subprocesses, files or eval results) without holding the GIL.
+def run_threads(stages, chunks, meta_data, stats=None):
+    names = [_stage_name(stage) for stage in stages] + ['output']
+
+    handoff = HandOff(names[0], stats)
+    _start_thread(chunks, handoff)
+    for stage, name in zip(stages, names[1:]):
+        # a stage may take its input right away (as fences do), so the
+        # threads before it have to be running
+        chunks, meta_data = stage.pipe(_handed_off(handoff), meta_data)
+        handoff = HandOff(name, stats)
+        _start_thread(chunks, handoff)
+
+    return _handed_off(handoff), meta_data
+
+
+def _stage_name(stage):
+    stage = getattr(stage, 'stage', stage)
+    return type(stage).__name__
+
+
+def _start_thread(chunks, handoff):
+    def run():
+        try:
+            for batch in _batches(chunks):
+                handoff.put(batch)
+        except Exception as error:
+            handoff.put(Failure(error))
+        else:
+            handoff.put(END)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def _handed_off(handoff):
+    while True:
+        item = handoff.get()
+        if item is END:
+            return
+        if isinstance(item, Failure):
+            raise item.error
+        for chunk in item:
+            yield chunk
+
+
+# A queue between two stages of the threaded runner, named after the stage
+# that takes from it. It counts the batches that went through it, how many
+# were waiting in it, and the time the stages spent waiting for it: a stage
+# whose input queue is full most of the time, while its output queue is
+# empty, holds up the pipeline.
+class HandOff(object):
+    def __init__(self, name, stats=None):
+        self.name = name
+        self.queue = queues.Queue(QUEUE_SIZE)
+        self.batches = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+        if stats is not None:
+            stats.handoffs.append(self)
+
+    def put(self, item):
+        depth = self.queue.qsize()
+        self.depth += depth
+        self.max_depth = max(self.max_depth, depth)
+
+        begin = time.perf_counter()
+        self.queue.put(item)
+        self.put_wait += time.perf_counter() - begin
+        self.batches += 1
+
+    def get(self):
+        begin = time.perf_counter()
+        item = self.queue.get()
+        self.get_wait += time.perf_counter() - begin
+        return item
+
+
+# The HandOffs of the threaded runner (Toolchain.configure(queue_stats=...)),
+# for a report of how full each queue was.
+class QueueStats(object):
+    def __init__(self):
+        self.handoffs = []
+
+    def report(self, stream):
+        columns = ['queue to', 'batches', 'mean depth', 'max depth', 'put wait/s', 'get wait/s']
+
+        rows = []
+        for handoff in self.handoffs:
+            rows.append([
+                handoff.name,
+                str(handoff.batches),
+                '%.1f' % (float(handoff.depth) / (handoff.batches or 1)),
+                str(handoff.max_depth),
+                '%.3f' % handoff.put_wait,
+                '%.3f' % handoff.get_wait,
+            ])
+
+        widths = [max(len(row[i]) for row in [columns] + rows) for i in range(len(columns))]
+        for row in [columns] + rows:
+            cells = [row[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]
+            stream.write('  '.join(cells).rstrip() + '\n')
+
+
+RUNNERS = {
+    'async': run_async,
+    'threads': run_threads,
+}
@@ -27,6 +27,9 @@ def rchomp(string, n=0):
 
 
 def escape_chars(escape_char, chars_to_escape, text):
+    if escape_char not in text:
+        return text
+
     def escape(escape_sequence):
         escaped_char = escape_sequence.group(0)[1]
         if re.match(chars_to_escape, escaped_char):
@@ -1,92 +1,369 @@
 from . import ast
-from .weaklist import WeakList
+from . import binary
+from . import cache
+from . import runners
+from .chunkref import ChunkRef, chunk_ref
+from .incremental import relocate
 
+from collections import ChainMap, deque
 from functools import reduce
-from weakref import WeakKeyDictionary
 import copy
+import multiprocessing
+import os
+import sys
+import tempfile
 
 
 class Toolchain(object):
     def __init__(self, stages):
         self.stages = stages
-
-    # TODO: each stage needs their own meta data (shallow copying should do) so
-    # that re-indexing doesn't destroy a previous stage's state
+        self.fuse = False
+        self.runner = None
+        self.queue_stats = None
+
+    # With fuse=True, nested toolchains are run in line and consecutive
+    # ContentTools as one stage (see FusedContentTools). runner='async' runs
+    # the stages as coroutines instead, runner='threads' each in a thread of
+    # its own (see lib/runners); the latter counts how full the queues between
+    # them were in queue_stats (a runners.QueueStats).
+    def configure(self, fuse=False, runner=None, queue_stats=None, **settings):
+        self.fuse = fuse
+        self.runner = runner
+        self.queue_stats = queue_stats
+        for stage in self.stages:
+            if hasattr(stage, 'configure'):
+                stage.configure(fuse=fuse, runner=runner, queue_stats=queue_stats, **settings)
+
+    def reset(self):
+        for stage in self.stages:
+            if hasattr(stage, 'reset'):
+                stage.reset()
+
+    # Stages that write meta data do so in a layer of their own (see
+    # MetaData), so that re-indexing doesn't destroy a previous stage's state.
     def pipe(self, chunks, meta_data={}):
+        if self.runner is not None:
+            return runners.RUNNERS[self.runner](list(_flatten(self.stages)), chunks, meta_data, self.queue_stats)
+
+        stages = self.stages
+        if self.fuse:
+            stages = _fuse(_flatten(stages))
+
         return reduce(
             lambda state, stage: stage.pipe(state[0], state[1]),
-            (stage for stage in self.stages),
+            (stage for stage in stages),
             (chunks, meta_data)
         )
 
 
-# TODO:
-#   - add a WeakKeyDictionary containing a WeakList mapping
-#       each input chunk to its output chunks
-#   - store that input/output map in the tool itself so it dies when the tool
-#       does
-#   - we can now replicate the output chunks in order, even after updating some
-#       chunks
+# Meta data as seen by a stage: the keys the stage writes in the first
+# layer, over the layers of the stages before it, which are read through
+# but neither copied nor modified.
+class MetaData(ChainMap):
+    # ChainMap's own lookups raise and catch a KeyError in every layer that
+    # doesn't have the key
+    def __getitem__(self, key):
+        for mapping in self.maps:
+            if key in mapping:
+                return mapping[key]
+        return self.__missing__(key)
+
+    def get(self, key, default=None):
+        for mapping in self.maps:
+            if key in mapping:
+                return mapping[key]
+        return default
+
+
+# meta_data with a new first layer holding values
+def meta_data_layer(meta_data, values):
+    if isinstance(meta_data, ChainMap):
+        return MetaData(values, *meta_data.maps)
+    return MetaData(values, meta_data)
+
+
+# the stages of nested toolchains in line
+def _flatten(stages):
+    for stage in stages:
+        if isinstance(stage, Toolchain):
+            for inner_stage in _flatten(stage.stages):
+                yield inner_stage
+        else:
+            yield stage
+
+
+# consecutive ContentTools that don't run in worker processes grouped into
+# FusedContentTools
+def _fuse(stages):
+    result = []
+    group = []
+    for stage in stages:
+        if isinstance(stage, ContentTool) and not stage._parallel():
+            group.append(stage)
+            continue
+
+        if group:
+            result.append(group[0] if len(group) == 1 else FusedContentTools(group))
+            group = []
+        result.append(stage)
+
+    if group:
+        result.append(group[0] if len(group) == 1 else FusedContentTools(group))
+
+    return result
+
+
+# In incremental mode (configure(incremental=True)) each ContentTool records
+# the output chunks of every input chunk in self.iomap and keeps them until
+# the next run, which replays the recorded outputs of every input chunk it
+# has seen before instead of processing it again. Combined with ChunkReuse (lib/incremental), which
+# hands unchanged chunks of a re-read web back as the very same objects,
+# only the chunks that changed are processed by each stage.
+#
+# Stateful tools are always run on all chunks, but where their output equals
+# that of the previous run, the previous output chunks are passed on, so the
+# following stages can still replay theirs.
+#
+# Tools whose results depend on meta data that may change between runs (e.g.
+# through hooks in the meta code) give a replay_key() for each chunk, which
+# is recorded with its outputs; these are only replayed if the key is still
+# the same.
+#
+# Given a cache (configure(cache=DiskCache(...)), see lib/cache), the results
+# of tools that define cache_key() are also kept on disk and looked up there
+# before a chunk is processed.
 class ContentTool(object):
+    # Tools that keep state from one chunk to the next, modify their input
+    # chunks or look chunks up by identity set this, so that they are never
+    # run in worker processes.
+    stateful = False
+
+    # Stateful tools whose results don't depend on the order of the chunks
+    # (as they only look chunks up by identity) set this, so that the async
+    # runner may still hand them chunks out of order.
+    unordered = False
+
     def __init__(self, hooks=[]):
         super(ContentTool, self).__init__()
         self.hooks = hooks
-        self.iomap = WeakKeyDictionary()
+        self.iomap = {}
+        self.keymap = {}
+        self.jobs = None
+        self.incremental = False
+        self.cache = None
+        self.cache_misses = {}
+
+    def configure(self, jobs=None, incremental=False, cache=None, **settings):
+        self.jobs = jobs
+        self.incremental = incremental
+        self.cache = cache
+
+    # forget the outputs of the previous run, e.g. after the meta code changed
+    def reset(self):
+        self.iomap = {}
+        self.keymap = {}
+
+    # called before each run; stateful tools reset their state here
+    def restart(self):
+        pass
 
     def pipe(self, chunks, meta_data):
         return self._pipe_chunks(chunks, meta_data), meta_data
 
-    def _pipe_chunks(self, chunks, meta_data):
-        self.iomap = WeakKeyDictionary()
+    # the result for old_chunk: replayed, cached or computed
+    def _result(self, old_chunk, meta_data, replay):
+        for hook in self.hooks:
+            hook.before_chunk_process(old_chunk)
+
+        outputs = self._replayable(old_chunk, meta_data, replay)
+        if outputs is not None and self.stateful:
+            return _reuse(old_chunk, self.process_chunk(old_chunk, meta_data), outputs)
+        elif outputs is not None:
+            return _replay(old_chunk, outputs)
+
+        result = self._cached_result(old_chunk, meta_data)
+        if result is NOT_CACHED:
+            result = self.process_chunk(old_chunk, meta_data)
+        return result
+
+    def _process_chunks(self, chunks, meta_data, replay):
         for old_chunk in chunks:
             #old_repr = repr(old_chunk)
 
+            yield old_chunk, self._result(old_chunk, meta_data, replay)
+
+    def _process_chunks_parallel(self, chunks, meta_data, replay):
+        global _worker_tool, _worker_meta_data
+
+        # The workers are forked when the first batch is complete and see the
+        # tool and meta data as they are at that time. Replayed and cached
+        # chunks don't go to the workers; a batch cut short by one is
+        # processed here as long as no workers have been started.
+        pool = None
+        pending = deque()
+        batch = []
+
+        try:
+            for old_chunk in chunks:
+                for hook in self.hooks:
+                    hook.before_chunk_process(old_chunk)
+
+                outputs = self._replayable(old_chunk, meta_data, replay)
+                if outputs is not None:
+                    result = _replay(old_chunk, outputs)
+                else:
+                    result = self._cached_result(old_chunk, meta_data)
+
+                if result is NOT_CACHED:
+                    batch.append(old_chunk)
+                    if len(batch) < CHUNKS_PER_TASK:
+                        continue
+
+                if batch and pool is None and len(batch) < CHUNKS_PER_TASK:
+                    pending.append([(chunk, self.process_chunk(chunk, meta_data)) for chunk in batch])
+                    batch = []
+
+                if batch:
+                    if pool is None:
+                        _worker_tool, _worker_meta_data = self, meta_data
+                        pool = multiprocessing.get_context('fork').Pool(self.jobs)
+                        _worker_tool, _worker_meta_data = None, None
+
+                    pending.append(_batch_results(batch, pool.apply_async(_process_batch, (batch,))))
+                    batch = []
+
+                if result is not NOT_CACHED:
+                    pending.append([(old_chunk, result)])
+
+                while len(pending) >= TASKS_PER_JOB * self.jobs:
+                    for result in pending.popleft():
+                        yield result
+
+            while pending:
+                for result in pending.popleft():
+                    yield result
+
+            for old_chunk in batch:
+                yield old_chunk, self.process_chunk(old_chunk, meta_data)
+
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    # starts a run; returns the outputs of the previous run to replay, with
+    # the replay keys they were recorded under
+    def _start(self):
+        self.restart()
+        self.cache_misses = {}
+
+        replay = (self.iomap, self.keymap) if self.incremental else ({}, {})
+        self.iomap = {}
+        self.keymap = {}
+        return replay
+
+    # the recorded outputs of old_chunk, unless its replay key changed; the
+    # current key is recorded for the next run
+    def _replayable(self, old_chunk, meta_data, replay):
+        iomap, keymap = replay
+        if not self.incremental or self.stateful:
+            return iomap.get(old_chunk)
+
+        key = self.replay_key(old_chunk, meta_data)
+        if key != '':
+            self.keymap[old_chunk] = key
+
+        if key is None or key != keymap.get(old_chunk, ''):
+            return None
+        return iomap.get(old_chunk)
+
+    def _parallel(self):
+        return self.jobs and self.jobs > 1 and not self.stateful and PARALLEL
+
+    def _pipe_chunks(self, chunks, meta_data):
+        replay = self._start()
+
+        if self._parallel():
+            results = self._process_chunks_parallel(chunks, meta_data, replay)
+        else:
+            results = self._process_chunks(chunks, meta_data, replay)
+
+        for old_chunk, result in results:
+            for new_chunk in self._finish(old_chunk, result):
+                yield new_chunk
+
+    # records the result for old_chunk and returns its output chunks
+    def _finish(self, old_chunk, result):
+        key = self.cache_misses.pop(old_chunk, None)
+        if key is not None:
+            self._cache_result(key, old_chunk, result)
+
+        if isinstance(result, list):
+            #for new_chunk in result:
+            #    self._verify_not_mutated(old_chunk, old_repr, new_chunk)
+
             for hook in self.hooks:
-                hook.before_process_chunk(old_chunk)
+                hook.after_chunk_removed(old_chunk)
 
-            result = self.process_chunk(old_chunk, meta_data)
+            for new_chunk in result:
+                for hook in self.hooks:
+                    hook.after_chunk_added(new_chunk)
 
-            self.iomap.setdefault(old_chunk, WeakList())
+            outputs = result
 
-            if isinstance(result, list):
-                #for new_chunk in result:
-                #    self._verify_not_mutated(old_chunk, old_repr, new_chunk)
+        elif isinstance(result, ast.Chunk):
+            #self._verify_not_mutated(old_chunk, old_repr, result)
 
+            if result is old_chunk:
+                for hook in self.hooks:
+                    hook.after_chunk_unmodified(result)
+            else:
                 for hook in self.hooks:
                     hook.after_chunk_removed(old_chunk)
+                    hook.after_chunk_added(result)
 
-                for new_chunk in result:
-                    self.iomap[old_chunk].append(new_chunk)
+            outputs = [result]
 
-                    for hook in self.hooks:
-                        hook.after_chunk_added(new_chunk)
+        elif result is None:
+            for hook in self.hooks:
+                hook.after_chunk_removed(old_chunk)
 
-                    yield new_chunk
+            outputs = []
 
-            elif isinstance(result, ast.Chunk):
-                #self._verify_not_mutated(old_chunk, old_repr, result)
+        else:
+            # TODO: contract error: bad return value
+            raise RuntimeError()
 
-                if result is old_chunk:
-                    self.iomap[old_chunk].append(old_chunk)
+        if self.incremental:
+            self.iomap.setdefault(old_chunk, []).extend(outputs)
 
-                    for hook in self.hooks:
-                        hook.after_chunk_unmodified(result)
-                else:
-                    self.iomap[old_chunk].append(result)
+        for hook in self.hooks:
+            hook.after_chunk_process(old_chunk)
 
-                    for hook in self.hooks:
-                        hook.after_chunk_removed(old_chunk)
-                        hook.after_chunk_added(result)
+        return outputs
 
-                yield result
+    # the cached result for chunk, or NOT_CACHED; on a miss, the key is kept
+    # until the result is known
+    def _cached_result(self, chunk, meta_data):
+        if self.cache is None or self.stateful:
+            return NOT_CACHED
 
-            elif result is None:
-                for hook in self.hooks:
-                    hook.after_chunk_removed(old_chunk)
+        key = self.cache_key(chunk, meta_data)
+        if key is None:
+            return NOT_CACHED
 
-            else:
-                # TODO: contract error: bad return value
-                raise RuntimeError()
+        key = cache.result_key(self, key, chunk)
+        value = self.cache.get(key)
+        if value is None:
+            self.cache_misses[chunk] = key
+            return NOT_CACHED
+
+        return cache.decode_result(chunk, value)
+
+    def _cache_result(self, key, chunk, result):
+        try:
+            self.cache.put(key, cache.encode_result(chunk, result))
+        except (TypeError, AttributeError):
+            pass
 
     #def _verify_not_mutated(self, old_chunk, old_repr, new_chunk):
     #    if new_chunk is old_chunk and repr(new_chunk) != old_repr:
@@ -99,6 +376,149 @@ class ContentTool(object):
     def process_chunk(self, chunk, meta_data):
         return chunk
 
+    # Tools whose results may be cached return a string here that covers
+    # their arguments and everything in meta_data the result depends on
+    # (besides the chunk itself), or None if the result for chunk is not
+    # worth caching.
+    def cache_key(self, chunk, meta_data):
+        return None
+
+    # Tools whose results depend on more of meta_data than the meta code
+    # (e.g. through hooks defined in it) return a string here that covers it,
+    # or None if the outputs recorded for chunk must not be replayed in
+    # incremental mode.
+    def replay_key(self, chunk, meta_data):
+        return ''
+
+    # A concurrent.futures.Future that process_chunk() waits for before it
+    # returns the result for chunk, or None. The async runner waits for it
+    # without holding up the chunks behind.
+    def pending(self, chunk, meta_data):
+        return None
+
+
+NOT_CACHED = object()
+
+
+# Parallel execution of ContentTools: chunks are sent to the workers in
+# batches of CHUNKS_PER_TASK, with at most TASKS_PER_JOB batches per worker
+# in flight. Workers are forked, as the tools and meta data cannot be pickled.
+CHUNKS_PER_TASK = 16
+TASKS_PER_JOB = 4
+PARALLEL = 'fork' in multiprocessing.get_all_start_methods()
+
+# Consecutive ContentTools run as one stage (Toolchain.configure(fuse=True)):
+# each chunk goes through all of them in one loop, instead of through one
+# generator per tool. Every tool still keeps its iomap, cache and hooks as if
+# it ran on its own, and sees the chunks in the same order.
+class FusedContentTools(object):
+    def __init__(self, tools):
+        self.tools = tools
+
+    def pipe(self, chunks, meta_data):
+        return self._pipe_chunks(chunks, meta_data), meta_data
+
+    def _pipe_chunks(self, chunks, meta_data):
+        stages = [(tool, tool._start()) for tool in self.tools]
+
+        for chunk in chunks:
+            new_chunks = [chunk]
+            for tool, replay in stages:
+                if len(new_chunks) == 1:
+                    old_chunk = new_chunks[0]
+                    new_chunks = tool._finish(old_chunk, tool._result(old_chunk, meta_data, replay))
+                else:
+                    old_chunks, new_chunks = new_chunks, []
+                    for old_chunk in old_chunks:
+                        new_chunks.extend(tool._finish(old_chunk, tool._result(old_chunk, meta_data, replay)))
+
+            for new_chunk in new_chunks:
+                yield new_chunk
+
+
+# result of an input chunk from the outputs recorded in the previous run,
+# which take over the location of the chunk if it moved
+def _replay(chunk, outputs):
+    if len(outputs) == 1 and outputs[0] is chunk:
+        return chunk
+    return [relocate(output, chunk) for output in outputs]
+
+
+# result of a stateful tool, replaced by the outputs of the previous run if
+# they are the same
+def _reuse(chunk, result, outputs):
+    if isinstance(result, list):
+        new_outputs = result
+    elif result is None:
+        new_outputs = []
+    else:
+        new_outputs = [result]
+
+    if len(new_outputs) != len(outputs):
+        return result
+    if all(new is old for new, old in zip(new_outputs, outputs)):
+        return result
+
+    for output in outputs:
+        relocate(output, chunk)
+
+    try:
+        if binary.dumps(new_outputs) != binary.dumps(outputs):
+            return result
+    except (TypeError, AttributeError):
+        return result
+
+    return _replay(chunk, outputs)
+
+
+UNMODIFIED = 'unmodified'
+SINGLE = 'single'
+
+_worker_tool = None
+_worker_meta_data = None
+
+
+# Results are sent back in the binary interchange format, which is several
+# times smaller and faster to produce than pickled elements. Results that
+# it cannot represent are pickled instead.
+def _process_batch(chunks):
+    shapes = []
+    nodes = []
+    for chunk in chunks:
+        result = _worker_tool.process_chunk(chunk, _worker_meta_data)
+        if result is chunk:
+            # don't send back a copy of a chunk that the tool passed through
+            shapes.append(UNMODIFIED)
+        elif isinstance(result, list):
+            shapes.append(len(result))
+            nodes.extend(result)
+        else:
+            shapes.append(result if result is None else SINGLE)
+            if result is not None:
+                nodes.append(result)
+
+    try:
+        return shapes, binary.dumps(nodes)
+    except (TypeError, AttributeError):
+        return shapes, nodes
+
+
+def _batch_results(chunks, async_result):
+    shapes, nodes = async_result.get()
+    if isinstance(nodes, bytes):
+        nodes = binary.loads(nodes)
+
+    nodes = iter(nodes)
+    for chunk, shape in zip(chunks, shapes):
+        if shape == UNMODIFIED:
+            yield chunk, chunk
+        elif shape == SINGLE:
+            yield chunk, next(nodes)
+        elif shape is None:
+            yield chunk, None
+        else:
+            yield chunk, [next(nodes) for i in range(shape)]
+
 
 class MetaAttribTool(object):
     def __init__(self, attrib_names=[]):
@@ -110,14 +530,38 @@ class MetaAttribTool(object):
         return state
 
 
+# In incremental mode (configure(incremental=True)), tools that set
+# updatable keep their meta data from one run to the next. Each run compares
+# its chunks with those of the previous run; from the first chunk that
+# differs on, the old chunks are taken out again with remove_chunk() (last
+# one first) and the new ones added with add_chunk(). Other tools rebuild
+# their meta data in every run.
 class MetaDataTool(object):
+    updatable = False
+
     def __init__(self, names=[], initial_values={}):
         self.names    = names
         self.initial  = initial_values
+        self.incremental = False
+        self.chunks   = []
+        self.state    = None
+
+    def configure(self, incremental=False, **settings):
+        self.incremental = incremental
+
+    def reset(self):
+        self.chunks = []
+        self.state  = None
 
     def pipe(self, chunks, old_meta_data):
-        new_meta_data = copy.copy(old_meta_data)
-        new_meta_data.update(copy.deepcopy(self.initial))
+        if self.incremental and self.updatable:
+            if self.state is None:
+                self.chunks = []
+                self.state  = copy.deepcopy(self.initial)
+            new_meta_data = meta_data_layer(old_meta_data, dict(self.state))
+            return self._update_chunks(chunks, old_meta_data, new_meta_data), new_meta_data
+
+        new_meta_data = meta_data_layer(old_meta_data, copy.deepcopy(self.initial))
         return self._pipe_chunks(chunks, old_meta_data, new_meta_data), new_meta_data
 
     def _pipe_chunks(self, chunks, old_meta_data, new_meta_data):
@@ -125,19 +569,60 @@ class MetaDataTool(object):
             self.add_chunk(chunk, old_meta_data, new_meta_data)
             yield chunk
 
+    def _update_chunks(self, chunks, old_meta_data, new_meta_data):
+        previous, self.chunks = self.chunks, []
+        complete = False
+
+        try:
+            for chunk in chunks:
+                if previous is not None:
+                    i = len(self.chunks)
+                    if i < len(previous) and previous[i] is chunk:
+                        self.chunks.append(chunk)
+                        yield chunk
+                        continue
+
+                    self._remove_chunks(previous[i:], old_meta_data, new_meta_data)
+                    previous = None
+
+                self.add_chunk(chunk, old_meta_data, new_meta_data)
+                self.chunks.append(chunk)
+                yield chunk
+
+            if previous is not None:
+                self._remove_chunks(previous[len(self.chunks):], old_meta_data, new_meta_data)
+
+            complete = True
+        finally:
+            # the meta data no longer matches self.chunks; start over next time
+            if not complete:
+                self.reset()
+
+    def _remove_chunks(self, chunks, old_meta_data, new_meta_data):
+        for chunk in reversed(chunks):
+            self.remove_chunk(chunk, old_meta_data, new_meta_data)
+
     # process_chunk must be "symmetric"; that enables updatability
-    # TODO: add remove() or similar
     # TODO: add on_content_change() or similar
     # TODO: add on_meta_attrib_change() or similar
     # TODO: see to it that remove() is called on object destruction
     def add_chunk(self, chunk, old_meta_data, new_meta_data):
         return new_meta_data
 
+    # undoes add_chunk() for a chunk that was the last one added
+    def remove_chunk(self, chunk, old_meta_data, new_meta_data):
+        return new_meta_data
+
 
+# Called for each chunk a ContentTool takes: before_chunk_process() first,
+# after_chunk_process() last, once its output chunks are known.
 class ContentToolHook(object):
     def before_chunk_process(self, chunk):
         pass
 
+    def after_chunk_process(self, chunk):
+        pass
+
     def after_chunk_added(self, chunk):
         pass
 
@@ -160,19 +645,98 @@ class PopOnIteration(object):
             yield self.items.pop()
 
 
+# Holds back all chunks until the last one has gone through the stages
+# before it. With configure(spill=N), at most N chunks are kept in memory and
+# the rest are written to a temporary file (see SpilledChunks). A spilled
+# chunk comes back as a new object, so meta data refers to chunks by their
+# ChunkRef, which reads a spilled chunk back when it is looked up before the
+# fence lets it go. Incremental runs keep all chunks until the next run
+# anyway, and need them to stay the same objects, so they never spill.
 class Fence(object):
     def __init__(self):
-        pass
+        self.spill = None
+
+    def configure(self, spill=None, incremental=False, **settings):
+        self.spill = None if incremental else spill
 
     def pipe(self, chunks, meta_data):
+        if self.spill is not None:
+            return SpilledChunks(chunks, self.spill), meta_data
         return PopOnIteration(list(chunks)), meta_data
 
 
+# The chunks, in order, of which at most max_chunks are held in memory; the
+# others are kept in a temporary file in the binary interchange format until
+# they are read back on iteration (or through their ChunkRef). Chunks that
+# cannot be serialized stay in memory, and a spilled chunk that another stage
+# or meta code still holds stays there as well; both are reported, as the
+# bound is not met for them.
+class SpilledChunks(object):
+    def __init__(self, chunks, max_chunks):
+        self.items = []
+        self.spilled = 0
+        self.file = None
+
+        in_memory = 0
+        unserializable = 0
+        for chunk in chunks:
+            if in_memory >= max_chunks:
+                try:
+                    data = binary.dumps([chunk])
+                    ref = chunk_ref(chunk)
+                except (TypeError, AttributeError):
+                    unserializable += 1
+                else:
+                    # a chunk that comes by twice is spilled once only
+                    if ref.store is None:
+                        if self.file is None:
+                            self.file = tempfile.TemporaryFile()
+                        ref.spill(self, self.file.tell(), len(data))
+                        self.file.write(data)
+                        self.items.append(ref)
+                        self.spilled += 1
+                        continue
+
+            self.items.append(chunk)
+            in_memory += 1
+        chunk = None
+
+        if self.file is not None:
+            self.file.flush()
+
+        held = sum(1 for item in self.items if isinstance(item, ChunkRef) and item.held())
+        if unserializable or held:
+            sys.stderr.write('spill: %d chunks over --spill=%d stay in memory ' \
+                    '(%d cannot be serialized, %d are held by other stages)\n' % \
+                    (unserializable + held, max_chunks, unserializable, held))
+
+    # the spilled chunk at offset; positioned, as forked workers share the file
+    def read(self, offset, size):
+        return binary.loads(os.pread(self.file.fileno(), size, offset))[0]
+
+    def __iter__(self):
+        items, self.items = self.items, []
+        items.reverse()
+
+        try:
+            while items:
+                item = items.pop()
+                yield item.unspill() if isinstance(item, ChunkRef) else item
+        finally:
+            for item in items:
+                if isinstance(item, ChunkRef):
+                    item.drop()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
 class SideEffectsTool(object):
     def __init__(self):
         pass
 
     def pipe(self, chunks, meta_data):
+        meta_data = meta_data_layer(meta_data, {})
         return self._pipe_chunks(chunks, meta_data), meta_data
 
     def _pipe_chunks(self, chunks, meta_data):
@@ -5,31 +5,48 @@ import re
 
 
 class AdHocChunks(ContentTool):
+    stateful = True
+
     def __init__(self):
         super(AdHocChunks, self).__init__()
-        self.chunk_id = 0
         self.adhoc_chunk_name = re.compile(r'^[^a-zA-Z0-9]+$')
+        self.restart()
+
+    def restart(self):
+        self.chunk_id = 0
         self.adhoc_chunk_names = {}
 
     def process_chunk(self, chunk, meta_data):
         self.chunk_id += 1
         Re = regex.Searcher()
 
+        result = chunk
+
         chunk_name = chunk.get('chunk_name')
         if chunk_name and Re.search(self.adhoc_chunk_name, chunk_name):
             if chunk_name in self.adhoc_chunk_names:
-                chunk.set('chunk_name', self.adhoc_chunk_names[chunk_name])
-                chunk.set('chunk_name_alias', chunk_name)
+                result = self._copy(chunk)
+                result.set('chunk_name', self.adhoc_chunk_names[chunk_name])
+                result.set('chunk_name_alias', chunk_name)
 
-        for element in chunk:
+        for i, element in enumerate(chunk):
             if ast.is_element_type(element, ast.Use):
                 chunk_name = element.get('chunk_name')
                 if Re.search(self.adhoc_chunk_name, chunk_name):
                     self.adhoc_chunk_names[chunk_name] = '%s %d' % (chunk_name, self.chunk_id)
-                    element.set('chunk_name', self.adhoc_chunk_names[chunk_name])
-                    element.set('chunk_name_alias', chunk_name)
-
-        return chunk
+                    if result is chunk:
+                        result = self._copy(chunk)
+                    result[i] = ast.copy_node(element)
+                    result[i].set('chunk_name', self.adhoc_chunk_names[chunk_name])
+                    result[i].set('chunk_name_alias', chunk_name)
+
+        return result
+
+    # chunks are not modified in place; the copy shares the children
+    def _copy(self, chunk):
+        result = ast.copy_node(chunk)
+        result.extend(list(chunk))
+        return result
 
 
 def adhoc(*args, **kwargs):
@@ -1,21 +1,30 @@
+from ..lib import ast
 from ..lib.toolchain import ContentTool
 
 import sys
 
 
 class Continue(ContentTool):
+    stateful = True
+
     def __init__(self):
         super(Continue, self).__init__()
+        self.restart()
+
+    def restart(self):
         self.previous = None
 
     def process_chunk(self, chunk, meta_data):
+        result = chunk
         if chunk.get('chunk_name') == '' and self.previous:
-            chunk.set('chunk_name', self.previous.get('chunk_name'))
-            chunk.set('quiet', True)
+            result = ast.copy_node(chunk)
+            result.extend(list(chunk))
+            result.set('chunk_name', self.previous.get('chunk_name'))
+            result.set('quiet', True)
 
-        self.previous = chunk
+        self.previous = result
 
-        return chunk
+        return result
 
 
 def cont(*args, **kwargs):
@@ -4,6 +4,8 @@ import sys
 
 
 class Dumper(ContentTool):
+    stateful = True
+
     def __init__(self):
         super(Dumper, self).__init__()
 
@@ -1,18 +1,22 @@
 from ..lib import ast
 from ..lib import regex
+from ..lib.cache import EvalCache
+from ..lib.chunkref import ChunkDictionary, ChunkList
 #from ..lib.textutils import striphead, striptail
 from ..lib.toolchain import Toolchain, ContentTool, MetaDataTool, Fence
-from ..lib.weaklist import WeakList
-from .xref_use import xref_use
+from .xref_use import xref_use, pop_index_entry
 
+import atexit
 import sys
 import os
 import os.path
 import re
 import subprocess
-import hashlib
-from weakref import WeakKeyDictionary
-from threading import Thread
+import time
+import traceback
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Thread, Timer, local
 
 
 # TODO:
@@ -22,6 +26,8 @@ from threading import Thread
 
 
 class ChunksByEvalSession(MetaDataTool):
+    updatable = True
+
     def __init__(self):
         super(ChunksByEvalSession, self).__init__(
             ['chunks_by_eval_session'],
@@ -31,18 +37,29 @@ class ChunksByEvalSession(MetaDataTool):
     def add_chunk(self, chunk, old_meta_data, new_meta_data):
         chunk_name = chunk.get('chunk_name')
         if chunk_name:
-            new_meta_data['chunks_by_eval_session'].setdefault(chunk_name, WeakList()).append(chunk)
+            new_meta_data['chunks_by_eval_session'].setdefault(chunk_name, ChunkList()).append(chunk)
+
+        preamble_name = chunk.get('eval_preamble')
+        if preamble_name:
+            new_meta_data['chunks_by_eval_session'].setdefault(preamble_name, ChunkList()).append(chunk)
 
+    def remove_chunk(self, chunk, old_meta_data, new_meta_data):
         preamble_name = chunk.get('eval_preamble')
         if preamble_name:
-            new_meta_data['chunks_by_eval_session'].setdefault(preamble_name, WeakList()).append(chunk)
+            pop_index_entry(new_meta_data['chunks_by_eval_session'], preamble_name)
+
+        chunk_name = chunk.get('chunk_name')
+        if chunk_name:
+            pop_index_entry(new_meta_data['chunks_by_eval_session'], chunk_name)
 
 
 class EvalTaskCreator(MetaDataTool):
+    updatable = True
+
     def __init__(self):
         super(EvalTaskCreator, self).__init__(
-            ['eval_tasks'],
-            dict(eval_tasks=WeakKeyDictionary())
+            ['eval_tasks', 'eval_commands'],
+            dict(eval_tasks=ChunkDictionary(), eval_commands=ChunkDictionary())
         )
         self.presets = {
             'R':                    preset_R,
@@ -51,6 +68,14 @@ class EvalTaskCreator(MetaDataTool):
             'coq':                  preset_coq,
             'coq verbose':          preset_coq_verbose,
         }
+        # the interpreters the presets run, for InterpreterPool
+        self.commands = {
+            'R':                    R_COMMAND,
+            'R verbose':            R_COMMAND,
+            'R unquoted':           R_SLAVE_COMMAND,
+            'coq':                  COQ_COMMAND,
+            'coq verbose':          COQ_COMMAND,
+        }
         self.schemes = {
             'shell':                scheme_shell
         }
@@ -72,6 +97,7 @@ class EvalTaskCreator(MetaDataTool):
                     return
             elif chunk.get('eval') in self.presets:
                 job = self.presets[chunk.get('eval')]
+                new_meta_data['eval_commands'][chunk] = self.commands[chunk.get('eval')]
             else:
                 # TODO: error: unknown evaluation preset
                 #return chunk
@@ -79,66 +105,227 @@ class EvalTaskCreator(MetaDataTool):
 
             new_meta_data['eval_tasks'][chunk] = job
 
-
-class EvaluatorThread(Thread):
-    def __init__(self, task, chunk, meta_data):
-        super(EvaluatorThread, self).__init__()
-        self.task = task
-        self.chunk = chunk
+    def remove_chunk(self, chunk, old_meta_data, new_meta_data):
+        new_meta_data['eval_commands'].pop(chunk, None)
+        new_meta_data['eval_tasks'].pop(chunk, None)
+
+
+# the name of the session of chunk (see gather_input())
+def session_name(chunk):
+    return chunk.get('eval_preamble') or chunk.get('chunk_name')
+
+
+# For each evaluated chunk, the evaluated chunks before it that it depends
+# on: the one before it in its session, and those whose code it uses
+# (through chunks that are not evaluated, too). The edges go forward in the
+# document only, so that there are no cycles.
+def eval_dependencies(chunks, meta_data):
+    order = dict((chunk, i) for i, chunk in enumerate(chunks))
+    dependencies = dict((chunk, []) for chunk in chunks)
+
+    for name, session in meta_data['chunks_by_eval_session'].items():
+        previous = None
+        for chunk in session:
+            if chunk in order and session_name(chunk) == name:
+                if previous is not None:
+                    dependencies[chunk].append(previous)
+                previous = chunk
+
+    used_by = meta_data.get('used_by', {})
+    for chunk in chunks:
+        names = [chunk.get('chunk_name')]
+        seen = set(names)
+        while names:
+            for user in used_by.get(names.pop(), []):
+                if user in order:
+                    if order[user] > order[chunk] and chunk not in dependencies[user]:
+                        dependencies[user].append(chunk)
+                elif user.get('chunk_name') not in seen:
+                    seen.add(user.get('chunk_name'))
+                    names.append(user.get('chunk_name'))
+
+    return dependencies
+
+
+# Runs eval tasks in an executor of a number of threads, each as soon as the
+# tasks it depends on are done, in the order of their chunks otherwise:
+# independent sessions run in parallel, the chunks of a session in order.
+# A task that raises is reported and the chunk's result is None (as an
+# exception ended just the thread a task ran in before); a task that ran a
+# command which exited with a nonzero status (see shell_exec) is reported and
+# keeps its result. The tasks that depend on a failed task either way are
+# skipped, and their chunks are their results. An interpreter session
+# (--eval_sessions) keeps running from one chunk to the next and has no exit
+# status for a chunk, so there only a session that breaks down fails a task.
+# finished is called when all tasks are done.
+class EvalScheduler(object):
+    def __init__(self, tasks, dependencies, meta_data, workers, finished=None):
+        self.tasks = dict(tasks)
         self.meta_data = meta_data
-        self.result = None
+        self.executor = ThreadPoolExecutor(workers)
+        self.finished = finished
+        self.lock = Lock()
+        self.failed = set()
+
+        self.futures = dict((chunk, Future()) for chunk, task in tasks)
+        self.waiting = dict((chunk, len(dependencies[chunk])) for chunk, task in tasks)
+        self.dependents = {}
+        for chunk, task in tasks:
+            for dependency in dependencies[chunk]:
+                self.dependents.setdefault(dependency, []).append(chunk)
+
+        self.ready = [chunk for chunk, task in tasks if not self.waiting[chunk]]
+
+    # starts the tasks; returns the futures of their results, by chunk
+    def start(self):
+        futures = dict(self.futures)
+        self._start(self.ready)
+        return futures
+
+    def _start(self, chunks):
+        chunks = list(reversed(chunks))
+        while chunks:
+            chunk = chunks.pop()
+            if chunk in self.failed:
+                sys.stderr.write('eval: skipped %s, which depends on a failed chunk\n' % \
+                        (chunk.get('chunk_name') or 'an unnamed chunk'))
+                chunks.extend(reversed(self._done(chunk, chunk)))
+            else:
+                self.executor.submit(self._run, chunk)
 
-    def run(self):
-        self.result = self.task(self.chunk, self.meta_data)
+        with self.lock:
+            if self.tasks or self.executor is None:
+                return
+            # the workers end when the tasks are done
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+        if self.finished is not None:
+            self.finished()
+
+    def _run(self, chunk):
+        _exit_status.value = 0
+        try:
+            result = self.tasks[chunk](chunk, self.meta_data)
+        except Exception:
+            traceback.print_exc()
+            self.failed.add(chunk)
+            result = None
+        else:
+            if _exit_status.value:
+                sys.stderr.write('eval: %s failed, its command exited with status %d\n' % \
+                        (chunk.get('chunk_name') or 'an unnamed chunk', _exit_status.value))
+                self.failed.add(chunk)
+        self._start(self._done(chunk, result))
+
+    # sets the result of chunk; returns the chunks that are ready now
+    def _done(self, chunk, result):
+        ready = []
+        with self.lock:
+            del self.tasks[chunk]
+            for dependent in self.dependents.pop(chunk, []):
+                if chunk in self.failed:
+                    self.failed.add(dependent)
+                self.waiting[dependent] -= 1
+                if not self.waiting[dependent]:
+                    ready.append(dependent)
+
+        self.futures.pop(chunk).set_result(result)
+        return ready
 
 
 # TODO: consider session mode properly
 # TODO: Cache: timestamp-based?
+# All tasks go to an EvalScheduler of eval_workers threads (the number of
+# CPUs by default) when the first chunk comes by. The results are futures,
+# which EvalResultAssigner waits for as their chunks come by, so that the
+# chunks without a task pass right away. With eval_sessions, the presets
+# keep an interpreter running for each session (see InterpreterSessions);
+# with eval_pool, they take their interpreters from an InterpreterPool, which
+# is kept from one run to the next. The tasks find these in the meta data,
+# and the EvalCache of their results.
+# Not updatable: a result depends on the session preamble and on the chunks
+# used by the evaluated chunk, so every task is run again (and answered from
+# the EvalCache if its input didn't change).
 class EvalTaskRunner(MetaDataTool):
     def __init__(self):
         super(EvalTaskRunner, self).__init__(
-            ['eval_task_results'],
-            dict(eval_task_results=WeakKeyDictionary())
+            ['eval_task_results', 'eval_sessions', 'eval_pool', 'eval_cache'],
+            dict(eval_task_results=ChunkDictionary(), eval_sessions=None, eval_pool=None, eval_cache=None)
         )
-        self.threads = WeakKeyDictionary()
+        self.workers = None
+        self.sessions = False
+        self.pool = None
+        self.cache = None
+        self.started = False
+
+    def configure(self, eval_workers=None, eval_sessions=False, eval_pool=None, eval_pool_idle=None, eval_cache=None, **settings):
+        super(EvalTaskRunner, self).configure(**settings)
+        self.workers = eval_workers
+        self.sessions = eval_sessions
+        if eval_cache is not None:
+            self.cache = eval_cache
+
+        idle = eval_pool_idle or DEFAULT_POOL_IDLE
+        if self.pool is not None and (self.pool.size, self.pool.idle) != (eval_pool, idle):
+            self.pool.close()
+            self.pool = None
+        if eval_pool and self.pool is None:
+            self.pool = InterpreterPool(eval_pool, idle)
+            atexit.register(self.pool.close)
+
+    def pipe(self, chunks, old_meta_data):
+        self.started = False
+        return super(EvalTaskRunner, self).pipe(chunks, old_meta_data)
 
     def add_chunk(self, chunk, old_meta_data, new_meta_data):
-        tasks = [(ch, old_meta_data['eval_tasks'][ch]) \
-                    for ch in old_meta_data['eval_tasks'] \
-                        if ch not in new_meta_data['eval_task_results']]
-
-        # create threads for the tasks and run them in parallel
-        for chunk_, task_ in tasks:
-            # wait for a running thread to terminate
-            running = [th for ch, th in self.threads.items() if th.isAlive()]
-            while len(running) >= 8:
-                for th in running:
-                    if not th.isAlive():
-                        running.remove(th)
-                        break
-                if running:
-                    running[0].join(0.01)
-
-            # create and start new thread
-            th = EvaluatorThread(task_, chunk_, old_meta_data)
-            th.start()
-            self.threads[chunk_] = th
-
-        # retrieve results
-        for ch, th in self.threads.items():
-            th.join()
-            new_meta_data['eval_task_results'][ch] = th.result
-
-        self.threads = WeakKeyDictionary()
+        if self.started:
+            return
+        self.started = True
+
+        tasks = list(old_meta_data['eval_tasks'].items())
+        if not tasks:
+            return
+
+        if self.cache is None:
+            self.cache = EvalCache()
+        new_meta_data['eval_cache'] = self.cache
+
+        if self.pool is not None:
+            new_meta_data['eval_pool'] = self.pool
+            stderr = subprocess.DEVNULL if self.sessions else subprocess.PIPE
+            for command in sorted(set(old_meta_data['eval_commands'].values())):
+                self.pool.warm(command, stderr)
+
+        finished = None
+        if self.sessions:
+            new_meta_data['eval_sessions'] = InterpreterSessions(self.pool)
+            finished = new_meta_data['eval_sessions'].close
+
+        dependencies = eval_dependencies([chunk_ for chunk_, task_ in tasks], old_meta_data)
+        scheduler = EvalScheduler(
+            tasks,
+            dependencies,
+            new_meta_data,
+            min(self.workers or os.cpu_count() or 1, len(tasks)),
+            finished
+        )
+        new_meta_data['eval_task_results'].update(scheduler.start())
 
 
 class EvalResultAssigner(ContentTool):
+    stateful = True
+    unordered = True
+
     def __init__(self):
         super(EvalResultAssigner, self).__init__()
 
+    def pending(self, chunk, meta_data):
+        return meta_data['eval_task_results'].get(chunk)
+
     def process_chunk(self, chunk, meta_data):
         if chunk in meta_data['eval_task_results']:
-            return meta_data['eval_task_results'][chunk]
+            return meta_data['eval_task_results'][chunk].result()
         else:
             return chunk
 
@@ -189,69 +376,35 @@ def output(chunk, meta_data, elements):
     return src_chunk, out_chunk
 
 
-class HashDbCache(object):
-    def __init__(self):
-        pass
-
-    def _cache_file_base(self, command, input):
-        dirname = '_yaweb_eval'
-        command_hash = hashlib.sha256(command.encode()).hexdigest()
-        input_hash = hashlib.sha256(input.encode()).hexdigest()
-        return '%s/%s/%s' % (dirname, command_hash, input_hash)
-
-    def get(self, command, input):
-        try:
-            base = self._cache_file_base(command, input)
-
-            fret = open(base + '/ret', 'r')
-            ret  = int(fret.read())
-
-            fout = open(base + '/out', 'r')
-            out  = fout.read()
-
-            ferr = open(base + '/err', 'r')
-            err  = ferr.read()
-
-            return ret, out, err
-        except:
-            return None
-
-    def set(self, command, input, value):
-        try:
-            base = self._cache_file_base(command, input)
-
-            if not os.path.isdir(base):
-                os.makedirs(base)
-
-            ret, out, err = value
-
-            fret = open(base + '/ret', 'w')
-            fret.write(str(ret))
+# a process running command (from pool, if given)
+def spawn(command, stderr, pool=None):
+    if pool is not None:
+        return pool.take(command, stderr)
 
-            fout = open(base + '/out', 'w')
-            fout.write(out)
+    return subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=stderr,
+        shell=True
+    )
 
-            ferr = open(base + '/err', 'w')
-            ferr.write(err)
-        except Exception as x:
-            sys.stderr.write(str(x) + '\n')
-            pass
 
+# The last nonzero exit status of a command run by the task in the current
+# thread, or 0 (see EvalScheduler._run).
+_exit_status = local()
 
-def shell_exec(command, input):
-    cache = HashDbCache()
 
-    result = cache.get(command, input)
+# the result (return code, output, error output) of command for input, from
+# cache if given
+def shell_exec(command, input, pool=None, cache=None):
+    result = cache.get(command, input) if cache is not None else None
     if result:
+        if result[0]:
+            _exit_status.value = result[0]
         return result
     else:
-        process = subprocess.Popen(
-            command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True
-        )
+        process = spawn(command, subprocess.PIPE, pool)
         out, err = process.communicate(input.encode())
 
         out = out.decode()
@@ -264,15 +417,18 @@ def shell_exec(command, input):
             err += '\n'
 
         result = (ret, out, err)
+        if ret:
+            _exit_status.value = ret
 
-        cache.set(command, input, result)
+        if cache is not None:
+            cache.set(command, input, result)
         return result
 
 
-def shell_exec_session(command, preamble, input):
+def shell_exec_session(command, preamble, input, pool=None, cache=None):
     if preamble:
-        ret_, out_, err_ = shell_exec(command, preamble)
-        ret, out, err = shell_exec(command, preamble + os.linesep + input)
+        ret_, out_, err_ = shell_exec(command, preamble, pool, cache)
+        ret, out, err = shell_exec(command, preamble + os.linesep + input, pool, cache)
 
         lines_ = out_.split('\n')
         if len(lines_) > 1:
@@ -282,12 +438,226 @@ def shell_exec_session(command, preamble, input):
         else:
             pre = ''
     else:
-        ret, out, err = shell_exec(command, input)
+        ret, out, err = shell_exec(command, input, pool, cache)
         pre = ''
 
     return ret, out, err, pre
 
 
+DEFAULT_POOL_IDLE = 60
+
+
+# Interpreter processes started ahead of demand (--eval_pool=N): N for each
+# command (and each way of handling its standard error) the presets of a web
+# run. A process is lent out once, for a run of the command or a session, and
+# another one is started in its place in the background; one that isn't taken
+# within idle seconds (--eval_pool_idle) is closed.
+class InterpreterPool(object):
+    def __init__(self, size, idle=DEFAULT_POOL_IDLE):
+        self.size = size
+        self.idle = idle
+        self.lock = Lock()
+        self.ready = {}     # (command, stderr) -> [(time started, process)]
+        self.starting = {}  # (command, stderr) -> number of processes starting
+
+    # starts processes running command in the background, up to size
+    def warm(self, command, stderr):
+        key = (command, stderr)
+        with self.lock:
+            count = self.size - len(self.ready.get(key, [])) - self.starting.get(key, 0)
+            if count <= 0:
+                return
+            self.starting[key] = self.starting.get(key, 0) + count
+
+        Thread(target=self._start, args=(key, count), daemon=True).start()
+
+    def _start(self, key, count):
+        started = 0
+        try:
+            for i in range(count):
+                process = spawn(*key)
+                with self.lock:
+                    self.starting[key] -= 1
+                    self.ready.setdefault(key, []).append((time.monotonic(), process))
+                started += 1
+
+                timer = Timer(self.idle, self._expire)
+                timer.daemon = True
+                timer.start()
+        finally:
+            # the processes that couldn't be started are no longer expected,
+            # so that warm() starts them again
+            with self.lock:
+                self.starting[key] -= count - started
+
+    # a process running command that hasn't been used yet
+    def take(self, command, stderr):
+        key = (command, stderr)
+        process = None
+        with self.lock:
+            ready = self.ready.get(key, [])
+            while ready and process is None:
+                started, process = ready.pop(0)
+                if process.poll() is not None:
+                    process = None
+
+        self.warm(command, stderr)
+        return process or spawn(command, stderr)
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for key, ready in self.ready.items():
+                expired += [process for started, process in ready if now - started >= self.idle]
+                ready[:] = [(started, process) for started, process in ready if now - started < self.idle]
+
+        for process in expired:
+            process.communicate()
+
+    def close(self):
+        with self.lock:
+            ready, self.ready = self.ready, {}
+        for processes in ready.values():
+            for started, process in processes:
+                process.communicate()
+
+
+# An interpreter process kept running for an eval session, fed one chunk
+# after another. After each input it is sent a command (marker, formatted
+# with a token of its own) that outputs the token, and its output is read up
+# to that output (the first line matching done, formatted with the token);
+# the transcript of the input ends before the first line with the token.
+# An input that ends within a phrase would take the marker command into it,
+# so session_exec() only sends inputs that end between two phrases.
+class InterpreterSession(object):
+    def __init__(self, command, marker, done, pool=None):
+        self.process = spawn(command, subprocess.DEVNULL, pool)
+        self.marker = marker
+        self.done = done
+        self.chunks = []    # the chunks fed to the interpreter
+
+    def send(self, input):
+        token = 'yaweb_%s' % uuid.uuid4().hex
+        if input and not input.endswith('\n'):
+            input += '\n'
+
+        # written by a thread of its own, as the interpreter may not take
+        # more input while its output (e.g. the echo of the input) isn't read
+        def write():
+            try:
+                self.process.stdin.write((input + self.marker % token).encode())
+                self.process.stdin.flush()
+            except OSError:
+                # the interpreter ended; its output is read to the end
+                pass
+
+        writer = Thread(target=write, daemon=True)
+        writer.start()
+
+        lines = []
+        done = re.compile(self.done % token)
+        while True:
+            line = self.process.stdout.readline().decode()
+            if not line or done.search(line):
+                break
+            lines.append(line)
+
+        writer.join()
+
+        for i, line in enumerate(lines):
+            if token in line:
+                del lines[i:]
+                break
+
+        return ''.join(lines)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+# The InterpreterSessions of a run, by command and session name. The state of
+# an interpreter is that of its session's preamble: the chunks of the
+# preamble it hasn't seen are fed to it first, and one that has seen a chunk
+# that is not in the preamble of the next (one evaluated with eval_preamble)
+# is started anew.
+class InterpreterSessions(object):
+    def __init__(self, pool=None):
+        self.sessions = {}
+        self.pool = pool
+        self.lock = Lock()
+
+    # the transcript of input_t, which starts with the interpreter's banner
+    # if there is no preamble
+    def run(self, command, marker, chunk, meta_data, preamble, input_t):
+        key = (command, session_name(chunk))
+        with self.lock:
+            session = self.sessions.pop(key, None)
+
+        if session is not None and (len(session.chunks) > len(preamble) or \
+                any(ch is not ch_ for ch, ch_ in zip(session.chunks, preamble))):
+            session.close()
+            session = None
+        if session is None:
+            session = InterpreterSession(command, marker[0], marker[1], self.pool)
+
+        try:
+            yaweb = meta_data['yaweb']
+            missing = preamble[len(session.chunks):]
+            if missing:
+                session.send(''.join([yaweb.tangle(ch, meta_data) for ch in missing]))
+                session.chunks.extend(missing)
+
+            out = session.send(input_t)
+        except:
+            session.close()
+            raise
+
+        if chunk.get('chunk_name') == session_name(chunk):
+            session.chunks.append(chunk)
+            with self.lock:
+                self.sessions[key] = session
+        else:
+            session.close()
+
+        return out
+
+    def close(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            session.close()
+
+
+# the output of command for input_t in the eval session of chunk, taken from
+# the cache or from its InterpreterSession; marker is a triple (marker, done,
+# complete): the first two as InterpreterSession takes them, and a function
+# that tells whether a text ends between two phrases. If the preamble or the
+# input may end within a phrase, the result is None, and the chunk is to be
+# run on its own.
+def session_exec(sessions, command, marker, chunk, meta_data, preamble, preamble_t, input_t):
+    complete = marker[2]
+    if not (complete(preamble_t) and complete(input_t)):
+        return None
+
+    cache = meta_data.get('eval_cache')
+    key = (command + ' (session)', preamble_t + os.linesep + input_t)
+
+    result = cache.get(*key) if cache is not None else None
+    if result:
+        ret, out, err = result
+        return out
+
+    out = sessions.run(command, marker, chunk, meta_data, preamble, input_t)
+    if cache is not None:
+        cache.set(key[0], key[1], (0, out, ''))
+    return out
+
+
 # TODO: dependency/remake semantics?:
 # <<TARGET>>=
 # <<DEPENDENCY 1>>
@@ -295,29 +665,49 @@ def shell_exec_session(command, preamble, input):
 # <<DEPENDENCY 2>>
 
 
-def _interactive_session(chunk, meta_data, command, prompt_re, phrase_re, echo_response_re=r'^.*$', banner_lines=0):
+def _interactive_session(chunk, meta_data, command, prompt_re, phrase_re, echo_response_re=r'^.*$', banner_lines=0, marker=None):
     preamble, input = gather_input(chunk, meta_data)
     preamble_t, input_t = tangle_input(chunk, meta_data, preamble, input)
-    ret, out, err, pre = shell_exec_session(command, preamble_t, input_t)
 
     Re = regex.Searcher()
 
+    out = None
+    sessions = meta_data.get('eval_sessions')
+    if sessions is not None and marker is not None:
+        out = session_exec(sessions, command, marker, chunk, meta_data, preamble, preamble_t, input_t)
+
+    if out is not None:
+        # the transcript starts at the first prompt of input_t
+        outs = out.split('\n')
+        if not preamble:
+            del outs[0:banner_lines]
+    else:
+        ret, out, err, pre = shell_exec_session(command, preamble_t, input_t, meta_data.get('eval_pool'), meta_data.get('eval_cache'))
+        outs = out.split('\n')
+
+        if not preamble and len(outs) >= banner_lines:
+            # skip banner
+            del outs[0:banner_lines]
+        else:
+            # skip first prompt
+            if Re.search(prompt_re, outs[0]):
+                outs[0] = Re.match.group('prtail')
+                if outs[0] == '':
+                    del outs[0]
+
+    return _interactive_elements(chunk, meta_data, input_t, outs, prompt_re, phrase_re, echo_response_re)
+
+
+# the elements of the transcript outs (lines) of the interactive session of
+# input_t
+def _interactive_elements(chunk, meta_data, input_t, outs, prompt_re, phrase_re, echo_response_re):
+    Re = regex.Searcher()
+
     ins = iter(input_t.split('\n'))
     if '__next__' in dir(ins):      # python3
         ins_next = lambda: ins.__next__()
     else:                           # python2
         ins_next = lambda: ins.next()
-    outs = out.split('\n')
-
-    if not preamble and len(outs) >= banner_lines:
-        # skip banner
-        del outs[0:banner_lines]
-    else:
-        # skip first prompt
-        if Re.search(prompt_re, outs[0]):
-            outs[0] = Re.match.group('prtail')
-            if outs[0] == '':
-                del outs[0]
 
     # remove trailing blank lines and prompts
     while len(outs) >= 1:
@@ -408,14 +798,102 @@ def _interactive_session(chunk, meta_data, command, prompt_re, phrase_re, echo_r
     return [source, result]
 
 
+R_COMMAND = 'R --vanilla --quiet 2>/dev/null'
+R_SLAVE_COMMAND = 'R --vanilla --quiet --slave'
+COQ_COMMAND = 'coqtop -q 2>&1'
+
+# Whether R code ends between two phrases, as far as that can be told
+# without parsing it: outside of strings and brackets, and not after an
+# operator, a comma, a keyword that takes a body or the head of an if, for,
+# while or function. A text that can't be told is taken to be unfinished.
+R_TOKEN_RE = re.compile(r'''
+      (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`(?:[^`\\]|\\.)*`)
+    | (?P<open_string>["'`])
+    | (?P<comment>\#[^\n]*)
+    | (?P<word>[A-Za-z_.][A-Za-z0-9_.]*)
+    | (?P<space>\s+)
+    | (?P<other>.)
+''', re.DOTALL | re.VERBOSE)
+
+R_HEADS = set(['if', 'for', 'while', 'function', '\\'])
+R_BODIES = set(['else', 'repeat', 'in'])
+R_OPERATORS = set('+-*/^<>=!&|~,$@:?%')
+
+
+def r_complete(text):
+    brackets = []   # the open brackets, each with the token before it
+    last = None     # the last token that isn't space or a comment
+    head = False    # whether last closes the head of an if, for, ...
+
+    for match in R_TOKEN_RE.finditer(text):
+        kind, token = match.lastgroup, match.group()
+        if kind in ('space', 'comment'):
+            continue
+        if kind == 'open_string':
+            return False
+
+        head = False
+        if kind == 'other' and token in '([{':
+            brackets.append(last)
+        elif kind == 'other' and token in ')]}' and brackets:
+            head = brackets.pop() in R_HEADS and token == ')'
+        last = token
+
+    if brackets or head:
+        return False
+    return last is None or not (last in R_HEADS or last in R_BODIES or last in R_OPERATORS)
+
+
+# Whether Coq code ends between two phrases: outside of comments and strings,
+# after the full stop of a phrase. Bullets and braces don't end with one, so
+# a text that ends with them is taken to be unfinished.
+COQ_TOKEN_RE = re.compile(r'''
+      (?P<comment_open>\(\*)
+    | (?P<comment_close>\*\))
+    | (?P<string>"(?:[^"]|"")*")
+    | (?P<open_string>")
+    | (?P<space>\s+)
+    | (?P<other>.)
+''', re.DOTALL | re.VERBOSE)
+
+
+def coq_complete(text):
+    comments = 0
+    last = None
+
+    for match in COQ_TOKEN_RE.finditer(text):
+        kind, token = match.lastgroup, match.group()
+        if kind == 'comment_open':
+            comments += 1
+        elif kind == 'comment_close' and comments:
+            comments -= 1
+        elif comments or kind == 'space':
+            continue
+        elif kind == 'open_string':
+            return False
+        else:
+            last = token
+
+    return not comments and (last is None or last == '.')
+
+
+# commands that output a token, and how the output is recognized, for
+# InterpreterSessions, with a function that tells whether a text ends between
+# two phrases, so that the command can follow it; R echoes its input, so the
+# output has to differ from the command
+R_MARKER = ('cat("%s", "\\n", sep = ""); flush.console()\n', r'^%s$', r_complete)
+COQ_MARKER = ('Locate %s.\n', r'%s', coq_complete)
+
+
 def preset_R(chunk, meta_data):
     return _interactive_session(
         chunk,
         meta_data,
-        'R --vanilla --quiet 2>/dev/null',
+        R_COMMAND,
         r'^(?P<prompt>[>+] )(?P<prtail>.*)$',
         None,
-        r'^(?P<phrase>.*)\s*(?P<phrasE>)#!\Z'
+        r'^(?P<phrase>.*)\s*(?P<phrasE>)#!\Z',
+        marker=R_MARKER
     )
 
 
@@ -423,17 +901,26 @@ def preset_R_verbose(chunk, meta_data):
     return _interactive_session(
         chunk,
         meta_data,
-        'R --vanilla --quiet 2>/dev/null',
+        R_COMMAND,
         r'^(?P<prompt>[>+] )(?P<prtail>.*)$',
         None,
-        r'^(?P<phrase>.*)(?P<phrasE>)\Z'
+        r'^(?P<phrase>.*)(?P<phrasE>)\Z',
+        marker=R_MARKER
     )
 
 
 def preset_R_unquoted(chunk, meta_data):
     preamble, input = gather_input(chunk, meta_data)
     preamble_t, input_t = tangle_input(chunk, meta_data, preamble, input)
-    ret, out, err, pre = shell_exec_session('R --vanilla --quiet --slave', preamble_t, input_t)
+
+    out = None
+    sessions = meta_data.get('eval_sessions')
+    if sessions is not None:
+        out = session_exec(sessions, R_SLAVE_COMMAND, R_MARKER, chunk, meta_data, preamble, preamble_t, input_t)
+
+    if out is None:
+        ret, out, err, pre = shell_exec_session(R_SLAVE_COMMAND, preamble_t, input_t, meta_data.get('eval_pool'), meta_data.get('eval_cache'))
+
     source, result = output(chunk, meta_data, [ast.Text(text=out)])
     result.set('weave', 'unquoted')
     return [source, result]
@@ -443,11 +930,12 @@ def preset_coq(chunk, meta_data):
     return _interactive_session(
         chunk,
         meta_data,
-        'coqtop -q 2>&1',
+        COQ_COMMAND,
         r'^(?P<prompt>\w+ < )(?P<prtail>.*)$',
         r'^(?P<phrase>\s*$|[^.]+\.\s*)(?P<phtail>.*)\Z',
         r'^(?P<phrase>.*)\(\*!\*\)(?P<phrasE>\.\s*)\Z',
-        3
+        3,
+        COQ_MARKER
     )
 
 
@@ -455,18 +943,19 @@ def preset_coq_verbose(chunk, meta_data):
     return _interactive_session(
         chunk,
         meta_data,
-        'coqtop -q 2>&1',
+        COQ_COMMAND,
         r'^(?P<prompt>\w+ < )(?P<prtail>.*)$',
         r'^(?P<phrase>\s*$|[^.]+\.\s*)(?P<phtail>.*)\Z',
         r'^(?P<phrase>.*)(?P<phrasE>)\Z',
-        3
+        3,
+        COQ_MARKER
     )
 
 
 def scheme_shell(command, chunk, meta_data):
     preamble, input = gather_input(chunk, meta_data)
     preamble_t, input_t = tangle_input(chunk, meta_data, preamble, input)
-    ret, out, err, pre = shell_exec_session(command, preamble_t, input_t)
+    ret, out, err, pre = shell_exec_session(command, preamble_t, input_t, cache=meta_data.get('eval_cache'))
     source, result = output(chunk, meta_data, [ast.Text(text=out)])
     return [source, result]
 
@@ -9,119 +9,180 @@ from pygments.token import Token
 
 
 class Lexer(ContentTool):
-    def __init__(self):
+    def __init__(self, token_runs=False):
         super(Lexer, self).__init__()
+        self.token_runs = token_runs
 
     def process_chunk(self, chunk, meta_data):
         result = chunk
 
         if chunk.get('lang'):
-            result = lex_pygments(chunk)
+            result = lex_pygments(chunk, self.token_runs)
 
         yaweb = meta_data['yaweb']
         if 'lex' in yaweb.__dict__:
-            result = yaweb.__dict__['lex'](result, meta_data)
+            result = yaweb.__dict__['lex'](ast.expand_token_runs(result), meta_data)
 
         return result
 
+    # The lex hook may read anything in meta_data, so its results are only
+    # cached or replayed if the meta code also defines lex_cache_key(chunk,
+    # meta_data), returning a string that covers what the hook reads (or
+    # None). Chunks without a lang reach the hook as they are and may be
+    # changed in place, so their results are never cached.
+    def _hook_key(self, chunk, meta_data):
+        yaweb = meta_data['yaweb']
+        if 'lex_cache_key' not in yaweb.__dict__:
+            return None
+
+        hook_key = yaweb.__dict__['lex_cache_key'](chunk, meta_data)
+        if hook_key is None:
+            return None
+
+        return 'meta=%s hook=%s' % (meta_data.get('meta_digest', ''), hook_key)
+
+    def cache_key(self, chunk, meta_data):
+        if not chunk.get('lang'):
+            return None
+
+        key = 'token_runs=%r pygments=%s' % (self.token_runs, pygments.__version__)
+
+        if 'lex' not in meta_data['yaweb'].__dict__:
+            return key
+
+        hook_key = self._hook_key(chunk, meta_data)
+        if hook_key is None:
+            return None
+
+        return '%s %s' % (key, hook_key)
+
+    def replay_key(self, chunk, meta_data):
+        if 'lex' not in meta_data['yaweb'].__dict__:
+            return ''
+        return self._hook_key(chunk, meta_data)
+
+
+# Pygments token types, most specific first, and the elements they become.
+# Text and error tokens are split into one element per line.
+token_types = [
+    (Token.Comment.Special,     ast.SpecialComment),
+    (Token.Comment,             ast.Comment),
+
+    (Token.Operator.Word,       ast.WordOperator),
+    (Token.Operator,            ast.Operator),
+
+    (Token.Punctuation,         ast.Punctuation),
+
+    (Token.Keyword,             ast.Keyword),
+
+    (Token.Name.Builtin,        ast.BuiltinCodeEntityName),
+    (Token.Name.Class,          ast.ClassName),
+    (Token.Name.Constant,       ast.ConstantName),
+    (Token.Name.Exception,      ast.ExceptionName),
+    (Token.Name.Function,       ast.FunctionName),
+    (Token.Name.Label,          ast.LabelName),
+    (Token.Name.Namespace,      ast.NamespaceName),
+    (Token.Name.Variable,       ast.VariableName),
+    (Token.Name,                ast.CodeEntityName),
 
-def lex_pygments(chunk):
+    (Token.Number.Bin,          ast.LiteralNumberBin),
+    (Token.Number.Oct,          ast.LiteralNumberOct),
+    (Token.Number.Dec,          ast.LiteralNumberDec),
+    (Token.Number.Hex,          ast.LiteralNumberHex),
+    (Token.Number,              ast.LiteralNumber),
+
+    (Token.String.Char,         ast.LiteralChar),
+    (Token.String.Escape,       ast.LiteralChar),
+    (Token.String,              ast.LiteralString),
+
+    (Token.Literal,             ast.Literal),
+
+    (Token.Text,                None),
+    (Token.Error,               None),
+]
+
+
+# Maps a Pygments token type to its element class (None for text that is
+# split into lines, False if unhandled). The result only depends on the type,
+# so it is looked up once per type.
+token_class_cache = {}
+
+def token_class(token):
+    if token not in token_class_cache:
+        token_class_cache[token] = False
+        for token_type, element_class in token_types:
+            if pygments.token.is_token_subtype(token, token_type):
+                token_class_cache[token] = element_class
+                break
+    return token_class_cache[token]
+
+
+def lex_pygments(chunk, token_runs=False):
     #lexer = pygments.lexers.get_lexer_by_name(chunk.get('lang'), encoding='utf-8', outencoding='utf-8')
     lexer = pygments.lexers.get_lexer_by_name(chunk.get('lang'))
 
     elements = list(chunk)
 
-    result = ast.clone(chunk)
-    for element in list(result):
-        result.remove(element)
+    result = ast.copy_node(chunk)
+
+    # (element class, text) pairs of the lexed text since the last element
+    # that was passed through
+    tokens = []
+
+    def flush():
+        if token_runs:
+            result.append(ast.TokenRun.from_tokens(tokens))
+        else:
+            result.extend([element_class(text=text) for element_class, text in tokens])
+        del tokens[:]
 
     for element in elements:
         if element.tag == 'Text' or element.tag == 'Code':
             # Pygments appearantly strips line breaks at the beginning,
             # so save leading white space (for example, after a Use token)
-            match = re.search(r'^(?P<white>\s*)(?P<text>|\S.*)$', element.text)
+            source = element.text
+            match = re.search(r'^(?P<white>\s*)(?P<text>|\S.*)$', source)
             if match and match.group('white') is not '':
-                result.append(ast.Text(text=match.group('white')))
-                element.text = match.group('text')
-
-            for token, text in pygments.lex(element.text, lexer):
-                if pygments.token.is_token_subtype(token, Token.Comment.Special):
-                    result.append(ast.SpecialComment(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Comment):
-                    result.append(ast.Comment(text=text))
-
-                elif pygments.token.is_token_subtype(token, Token.Operator.Word):
-                    result.append(ast.WordOperator(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Operator):
-                    result.append(ast.Operator(text=text))
-
-                elif pygments.token.is_token_subtype(token, Token.Punctuation):
-                    result.append(ast.Punctuation(text=text))
-
-                elif pygments.token.is_token_subtype(token, Token.Keyword):
-                    result.append(ast.Keyword(text=text))
-
-                elif pygments.token.is_token_subtype(token, Token.Name.Builtin):
-                    result.append(ast.BuiltinCodeEntityName(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Name.Class):
-                    result.append(ast.ClassName(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Name.Constant):
-                    result.append(ast.ConstantName(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Name.Exception):
-                    result.append(ast.ExceptionName(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Name.Function):
-                    result.append(ast.FunctionName(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Name.Label):
-                    result.append(ast.LabelName(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Name.Namespace):
-                    result.append(ast.NamespaceName(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Name.Variable):
-                    result.append(ast.VariableName(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Name):
-                    result.append(ast.CodeEntityName(text=text))
-
-                elif pygments.token.is_token_subtype(token, Token.Number.Bin):
-                    result.append(ast.LiteralNumberBin(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Number.Oct):
-                    result.append(ast.LiteralNumberOct(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Number.Dec):
-                    result.append(ast.LiteralNumberDec(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Number.Hex):
-                    result.append(ast.LiteralNumberHex(text=text))
-                elif pygments.token.is_token_subtype(token, Token.Number):
-                    result.append(ast.LiteralNumber(text=text))
-
-                elif pygments.token.is_token_subtype(token, Token.String.Char):
-                    result.append(ast.LiteralChar(text=text))
-                elif pygments.token.is_token_subtype(token, Token.String.Escape):
-                    result.append(ast.LiteralChar(text=text))
-                elif pygments.token.is_token_subtype(token, Token.String):
-                    result.append(ast.LiteralString(text=text))
-
-                elif pygments.token.is_token_subtype(token, Token.Literal):
-                    result.append(ast.Literal(text=text))
-
-                elif pygments.token.is_token_subtype(token, Token.Text) \
-                        or pygments.token.is_token_subtype(token, Token.Error):
+                tokens.append((ast.Text, match.group('white')))
+                source = match.group('text')
+
+            for token, text in pygments.lex(source, lexer):
+                element_class = token_class(token)
+
+                if element_class:
+                    tokens.append((element_class, text))
+
+                elif element_class is None:
                     lines = text.split('\n')
                     for line in lines[:-1]:
-                        result.append(ast.Text(text=line + '\n'))
+                        tokens.append((ast.Text, line + '\n'))
                     if lines[-1]:
-                        result.append(ast.Text(text=lines[-1]))
+                        tokens.append((ast.Text, lines[-1]))
 
                 else:
                     sys.stderr.write('lex_pygments: unhandled token %s=%s\n' % (str(token), text))
+                    if tokens:
+                        flush()
                     result.append(element)
 
             # Pygments always terminates lines, even if the original line was not terminated.
-            if not element.text.endswith('\n') and result and result[-1].text.endswith(u'\n'):
-                result[-1].text = result[-1].text[:-1]
+            if not source.endswith('\n'):
+                if tokens:
+                    if tokens[-1][1].endswith(u'\n'):
+                        tokens[-1] = (tokens[-1][0], tokens[-1][1][:-1])
+                elif result and result[-1].text.endswith(u'\n'):
+                    result[-1].text = result[-1].text[:-1]
 
         else:
+            if tokens:
+                flush()
             result.append(element)
 
+    if tokens:
+        flush()
+
     return result
 
 
 def lex(*args, **kwargs):
-    return Lexer()
+    return Lexer(token_runs='token_runs' in kwargs)
@@ -2,6 +2,8 @@ from ..lib import ast
 from ..lib.toolchain import Toolchain, SideEffectsTool, Fence
 from .xref_use import xref_use
 
+import hashlib
+
 
 class MetaProcessor(SideEffectsTool):
     def __init__(self):
@@ -18,6 +20,11 @@ class MetaProcessor(SideEffectsTool):
             # interactive mode
             exec(input, yaweb.__dict__)
 
+            # identifies the meta code run so far (see ContentTool.cache_key())
+            meta_data['meta_digest'] = hashlib.sha256(
+                (meta_data.get('meta_digest', '') + input).encode('utf-8')
+            ).hexdigest()
+
 
 def meta(*args, **kwargs):
     return Toolchain([xref_use(), Fence(), MetaProcessor(), Fence()])
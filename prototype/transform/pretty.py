@@ -1,4 +1,5 @@
 from ..lib import ast
+from ..lib import cow
 from ..lib.toolchain import ContentTool
 
 
@@ -14,25 +15,74 @@ class PrettyPrinter(ContentTool):
         if 'tangle' in kwargs:
             self.tangling = True
 
-    def process_chunk(self, chunk, meta_data):
+    # name of the meta code function that pretty prints chunks, or None
+    def _hook_name(self, meta_data):
         yaweb = meta_data['yaweb']
 
-        pretty_print = None
+        hook_name = None
 
         if self.weaving and 'pretty_print' in yaweb.__dict__:
-            pretty_print = yaweb.__dict__['pretty_print']
+            hook_name = 'pretty_print'
 
         if self.tangling and 'pretty_print_code' in yaweb.__dict__:
-            pretty_print = yaweb.__dict__['pretty_print_code']
+            hook_name = 'pretty_print_code'
+
+        return hook_name
 
+    def _pretty_print(self, meta_data):
+        hook_name = self._hook_name(meta_data)
+        if hook_name is None:
+            return None
+        return meta_data['yaweb'].__dict__[hook_name]
+
+    def process_chunk(self, chunk, meta_data):
+        pretty_print = self._pretty_print(meta_data)
+
+        # the hook gets a copy-on-write view of the chunk (see lib/cow.py):
+        # what it leaves alone is shared with the chunk, and the chunk passes
+        # through if the hook changes nothing
         if pretty_print and chunk.get('weave') == 'quoted':
-            result = ast.clone(chunk)
+            expanded = ast.expand_token_runs(chunk)
+            result = cow.view(expanded)
             pretty_print(result, meta_data)
-            return result
+            result = cow.unwrap(result)
+            return chunk if result is expanded else result
 
         else:
             return chunk
 
+    # The hook may read anything in meta_data, so its results are only cached
+    # or replayed if the meta code also defines <hook>_cache_key(chunk,
+    # meta_data) (e.g. pretty_print_cache_key), returning a string that
+    # covers what the hook reads (or None).
+    def _hook_key(self, hook_name, chunk, meta_data):
+        yaweb = meta_data['yaweb']
+        if hook_name + '_cache_key' not in yaweb.__dict__:
+            return None
+
+        hook_key = yaweb.__dict__[hook_name + '_cache_key'](chunk, meta_data)
+        if hook_key is None:
+            return None
+
+        return 'meta=%s hook=%s' % (meta_data.get('meta_digest', ''), hook_key)
+
+    def cache_key(self, chunk, meta_data):
+        hook_name = self._hook_name(meta_data)
+        if hook_name is None or chunk.get('weave') != 'quoted':
+            return None
+
+        hook_key = self._hook_key(hook_name, chunk, meta_data)
+        if hook_key is None:
+            return None
+
+        return 'weave=%r tangle=%r %s' % (self.weaving, self.tangling, hook_key)
+
+    def replay_key(self, chunk, meta_data):
+        hook_name = self._hook_name(meta_data)
+        if hook_name is None or chunk.get('weave') != 'quoted':
+            return ''
+        return self._hook_key(hook_name, chunk, meta_data)
+
 
 def pretty(*args, **kwargs):
     return PrettyPrinter(*args, **kwargs)
@@ -1,37 +1,61 @@
+from ..lib.chunkref import ChunkDictionary, ChunkList
 from ..lib.toolchain import Toolchain, MetaDataTool
-from ..lib.weaklist import WeakList
 
-from weakref import WeakKeyDictionary, WeakSet
+
+# takes the last chunk added under key out of a name -> chunks index
+def pop_index_entry(index, key):
+    chunks = index[key]
+    chunks.pop(-1)
+    if not len(chunks):
+        del index[key]
 
 
 class UsesIndex(MetaDataTool):
+    updatable = True
+
     def __init__(self):
-        super(UsesIndex, self).__init__(['uses'], dict(uses=WeakKeyDictionary()))
+        super(UsesIndex, self).__init__(['uses'], dict(uses=ChunkDictionary()))
 
     def add_chunk(self, chunk, old_meta_data, new_meta_data):
         for use in chunk.findall('Use'):
             used_name = use.get('chunk_name')
             new_meta_data['uses'].setdefault(chunk, list()).append(used_name)
 
+    def remove_chunk(self, chunk, old_meta_data, new_meta_data):
+        new_meta_data['uses'].pop(chunk, None)
+
 
 class UsedByIndex(MetaDataTool):
+    updatable = True
+
     def __init__(self):
         super(UsedByIndex, self).__init__(['used_by'], dict(used_by={}))
 
     def add_chunk(self, chunk, old_meta_data, new_meta_data):
         for use in chunk.findall('Use'):
             used_name = use.get('chunk_name')
-            new_meta_data['used_by'].setdefault(used_name, WeakList()).append(chunk)
+            new_meta_data['used_by'].setdefault(used_name, ChunkList()).append(chunk)
+
+    def remove_chunk(self, chunk, old_meta_data, new_meta_data):
+        for use in reversed(chunk.findall('Use')):
+            pop_index_entry(new_meta_data['used_by'], use.get('chunk_name'))
 
 
 class ChunksByName(MetaDataTool):
+    updatable = True
+
     def __init__(self):
         super(ChunksByName, self).__init__(['chunks_by_name'], dict(chunks_by_name={}))
 
     def add_chunk(self, chunk, old_meta_data, new_meta_data):
         chunk_name = chunk.get('chunk_name')
         if chunk_name:
-            new_meta_data['chunks_by_name'].setdefault(chunk_name, WeakList()).append(chunk)
+            new_meta_data['chunks_by_name'].setdefault(chunk_name, ChunkList()).append(chunk)
+
+    def remove_chunk(self, chunk, old_meta_data, new_meta_data):
+        chunk_name = chunk.get('chunk_name')
+        if chunk_name:
+            pop_index_entry(new_meta_data['chunks_by_name'], chunk_name)
 
 
 def xref_use(*args, **kwargs):
@@ -6,9 +6,15 @@
 
 from .lib import ast
 from .lib import toolchain
+from .lib.cache import DiskCache, EvalCache, DEFAULT_PATH, DEFAULT_MAX_SIZE, DEFAULT_EVAL_PATH
+from .lib.incremental import ChunkReuse
+from .lib.instrument import Profiler
+from .lib.runners import QueueStats
 #from .lib import toolchain_debug
 from .lib.args import parse_args
 
+import atexit
+import os
 import sys
 import imp
 import importlib
@@ -54,6 +60,148 @@ class Yaweb(object):
         backend = kwargs.setdefault('backend', default_backends)
         del kwargs['backend']
 
+        jobs = kwargs.setdefault('jobs', None)
+        del kwargs['jobs']
+
+        if isinstance(jobs, list) and jobs and isinstance(jobs[0], str):
+            jobs = int(jobs[-1]) if jobs[-1] else os.cpu_count()
+
+        self.jobs = jobs
+
+        # --eval_workers=N runs at most N eval tasks at a time (by default as
+        # many as there are CPUs)
+        eval_workers = kwargs.setdefault('eval_workers', None)
+        del kwargs['eval_workers']
+
+        if isinstance(eval_workers, list) and eval_workers and isinstance(eval_workers[0], str):
+            eval_workers = int(eval_workers[-1]) if eval_workers[-1] else None
+
+        self.eval_workers = eval_workers
+
+        # --eval_sessions keeps an interpreter running for each session of
+        # the R and coq presets instead of running the session's preamble
+        # again for each chunk
+        eval_sessions = kwargs.setdefault('eval_sessions', False)
+        del kwargs['eval_sessions']
+
+        self.eval_sessions = bool(eval_sessions)
+
+        # --eval_pool=N starts N interpreters for each preset in use ahead of
+        # demand, --eval_pool_idle=S closes those not taken within S seconds
+        eval_pool = kwargs.setdefault('eval_pool', None)
+        del kwargs['eval_pool']
+
+        eval_pool_idle = kwargs.setdefault('eval_pool_idle', None)
+        del kwargs['eval_pool_idle']
+
+        if isinstance(eval_pool, list) and eval_pool and isinstance(eval_pool[0], str):
+            eval_pool = int(eval_pool[-1]) if eval_pool[-1] else 2
+
+        if isinstance(eval_pool_idle, list) and eval_pool_idle and isinstance(eval_pool_idle[0], str):
+            eval_pool_idle = float(eval_pool_idle[-1])
+
+        self.eval_pool = eval_pool
+        self.eval_pool_idle = eval_pool_idle
+
+        # run consecutive ContentTools in one loop (see Toolchain.configure())
+        fuse = kwargs.setdefault('fuse', False)
+        del kwargs['fuse']
+
+        self.fuse = bool(fuse)
+
+        # --runner=async runs the stages as coroutines, so that a chunk
+        # waiting for its eval result doesn't hold up the chunks behind it,
+        # --runner=threads each stage in a thread of its own (see
+        # lib/runners); with the latter, --queue_stats prints how full the
+        # queues between the stages were at exit
+        runner = kwargs.setdefault('runner', None)
+        del kwargs['runner']
+
+        queue_stats = kwargs.setdefault('queue_stats', None)
+        del kwargs['queue_stats']
+
+        if isinstance(runner, list) and runner and isinstance(runner[0], str):
+            runner = runner[-1]
+
+        if isinstance(queue_stats, list) and queue_stats and isinstance(queue_stats[0], str):
+            queue_stats = QueueStats()
+            atexit.register(queue_stats.report, sys.stderr)
+
+        self.runner = runner
+        self.queue_stats = queue_stats
+
+        # keep the stages' results from one call to the next and only
+        # process the chunks that changed; see reload()
+        incremental = kwargs.setdefault('incremental', False)
+        del kwargs['incremental']
+
+        self.incremental = bool(incremental)
+        self.reuse = ChunkReuse()
+
+        # --spill=N keeps at most N chunks in memory in each fence and writes
+        # the others to a temporary file
+        spill = kwargs.setdefault('spill', None)
+        del kwargs['spill']
+
+        if isinstance(spill, list) and spill and isinstance(spill[0], str):
+            spill = int(spill[-1])
+
+        self.spill = spill
+
+        # --cache[=path] keeps the results of the stages on disk (see
+        # lib/cache), --cache_size=MB limits its size
+        cache = kwargs.setdefault('cache', None)
+        del kwargs['cache']
+
+        cache_size = kwargs.setdefault('cache_size', DEFAULT_MAX_SIZE)
+        del kwargs['cache_size']
+
+        cache_stats = kwargs.setdefault('cache_stats', False)
+        del kwargs['cache_stats']
+
+        if isinstance(cache_size, list) and cache_size and isinstance(cache_size[0], str):
+            cache_size = int(float(cache_size[-1]) * (1 << 20))
+
+        if isinstance(cache, list) and cache and isinstance(cache[0], str):
+            cache = DiskCache(cache[-1] or DEFAULT_PATH, cache_size)
+
+        self.cache = cache
+        self.cache_stats = bool(cache_stats)
+
+        # the results of eval tasks are kept in --eval_cache=path (see
+        # lib/cache), of at most --eval_cache_size=MB
+        eval_cache = kwargs.setdefault('eval_cache', None)
+        del kwargs['eval_cache']
+
+        eval_cache_size = kwargs.setdefault('eval_cache_size', DEFAULT_MAX_SIZE)
+        del kwargs['eval_cache_size']
+
+        if isinstance(eval_cache_size, list) and eval_cache_size and isinstance(eval_cache_size[0], str):
+            eval_cache_size = int(float(eval_cache_size[-1]) * (1 << 20))
+
+        if isinstance(eval_cache, list) and eval_cache and isinstance(eval_cache[0], str):
+            eval_cache = eval_cache[-1] or None
+
+        self.eval_cache = EvalCache(eval_cache or DEFAULT_EVAL_PATH, eval_cache_size)
+
+        # --profile prints the time spent in each stage and the chunks that
+        # went through it at exit, --profile=memory also the memory they
+        # allocated
+        profile = kwargs.setdefault('profile', None)
+        del kwargs['profile']
+
+        if isinstance(profile, list) and profile and isinstance(profile[0], str):
+            profile = Profiler(memory=(profile[-1] == 'memory'))
+            atexit.register(profile.report, sys.stderr)
+
+        self.profiler = profile
+        self.tool_names = {}
+
+        self.args = args
+        self.kwargs = kwargs
+        self.frontend_descs = frontend
+        self.backend_descs = backend
+
         self.bootstrap_tools = []
         for bs in bootstrap:
             self.bootstrap_tools.append(self._load_tool(bs, ['', 'transform'], args, kwargs))
@@ -70,8 +218,26 @@ class Yaweb(object):
         for be in backend:
             self.backends.append(self._load_tool(be, ['', 'backend'], args, kwargs))
 
+    # Loads new frontends and backends (to read the web again and write it
+    # out again), keeping the transforms. kwargs override the arguments given
+    # to the constructor, e.g. input and output.
+    def reload(self, **kwargs):
+        g_kwargs = dict(self.kwargs)
+        g_kwargs.update(kwargs)
+
+        self.frontends = []
+        for fe in self.frontend_descs:
+            self.frontends.append(self._load_tool(fe, ['', 'frontend'], self.args, g_kwargs))
+
+        self.backends = []
+        for be in self.backend_descs:
+            self.backends.append(self._load_tool(be, ['', 'backend'], self.args, g_kwargs))
+
     def _load_tool(self, desc, parent_packages, g_args, g_kwargs):
         try:
+            if isinstance(desc, str):
+                desc = (desc, [], {})
+
             name, l_args, l_kwargs = desc
 
             args = [*g_args] + l_args
@@ -91,10 +257,15 @@ class Yaweb(object):
                 __package__
             )
 
-            return module.__dict__[class_name](*args, **kwargs)
+            tool = module.__dict__[class_name](*args, **kwargs)
+            self.tool_names[id(tool)] = '/'.join([p for p in parent_packages if p] + [name])
+            return tool
         finally:
                 pass
 
+    def _tool_name(self, tool):
+        return self.tool_names.get(id(tool), type(tool).__name__)
+
     def __call__(self):
         yaweb = YawebState()
         yaweb.load_tool = lambda desc, pkgs=[]: self._load_tool(desc, pkgs)
@@ -102,21 +273,67 @@ class Yaweb(object):
 
         meta_data_src = dict(yaweb=yaweb)
 
-        chunks_src = (chunk for fe in self.frontends for chunk in fe)
+        profiler = self.profiler
+
+        frontends = self.frontends
+        bootstrap_stages = self.bootstrap_tools
+        if profiler is not None:
+            frontends = [profiler.iterate(fe, profiler.stage_stats(self._tool_name(fe))) for fe in frontends]
+            bootstrap_stages = profiler.wrap(bootstrap_stages, self.tool_names)
+
+        chunks_src = (chunk for fe in frontends for chunk in fe)
 
-        bootstrap_tools = toolchain.Toolchain(self.bootstrap_tools)
+        bootstrap_tools = toolchain.Toolchain(bootstrap_stages)
+        if self.incremental:
+            chunks_src = self.reuse(chunks_src)
+            if profiler is not None:
+                chunks_src = profiler.iterate(chunks_src, profiler.stage_stats('reuse'))
+            chunks_src = list(chunks_src)
+        bootstrap_tools.configure(incremental=self.incremental, spill=self.spill)
         chunks_pre, meta_data_pre = bootstrap_tools.pipe(chunks_src, meta_data_src)
 
-        main_tools = toolchain.Toolchain(meta_data_pre['yaweb'].tools)
+        main_stages = meta_data_pre['yaweb'].tools
+        if profiler is not None:
+            main_stages = profiler.wrap(main_stages, self.tool_names)
+
+        main_tools = toolchain.Toolchain(main_stages)
+        main_tools.configure(
+            jobs=self.jobs,
+            eval_workers=self.eval_workers,
+            eval_sessions=self.eval_sessions,
+            eval_pool=self.eval_pool,
+            eval_pool_idle=self.eval_pool_idle,
+            eval_cache=self.eval_cache,
+            incremental=self.incremental,
+            cache=self.cache,
+            fuse=self.fuse,
+            spill=self.spill,
+            runner=self.runner,
+            queue_stats=self.queue_stats
+        )
+        if self.incremental and self.reuse.meta_changed:
+            main_tools.reset()
         chunks_out, meta_data_out = main_tools.pipe(chunks_pre, meta_data_pre)
 
+        web = None
         if self.backends:
             # process chunks (pull them through the pipeline)
             for chunk in chunks_out:
                 pass
         else:
             # process and return chunks
-            return ast.Web(children=list(chunks_out))
+            web = ast.Web(children=list(chunks_out))
+
+        if self.cache is not None:
+            self.cache.flush()
+            if self.cache_stats:
+                sys.stderr.write(self.cache.stats() + '\n')
+
+        self.eval_cache.flush()
+        if self.cache_stats and self.eval_cache.disk is not None:
+            sys.stderr.write(self.eval_cache.stats() + '\n')
+
+        return web
 
 
 def main(argv):